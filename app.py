@@ -1,20 +1,71 @@
-from queue import Queue, LifoQueue
-
-from flask import Flask, render_template, request, redirect, make_response
-
-from client_thread import ClientThread
-from utils import decode_image, inner_content, error_handler, create_initial_agent_queue, read_experience_logs
-
-app = Flask(__name__)
-
-image_queues = dict()
-action_queues = dict()
-agent_queue = LifoQueue()
-clients = dict()
-USER_ID_COUNTER = 0
-
-
-@app.route('/')
+import os
+import time
+from queue import Empty
+
+from flask import Blueprint, Flask, Response, g, render_template, request, redirect, make_response
+
+from image_bpm import INGEST_REDUCTION, reduce_frame
+from metrics import get_metrics
+from model_registry import ModelRegistry
+from session_backend import make_backend
+from session_manager import SessionManager
+from utils import (decode_image, decode_image_bytes, inner_content, error_handler, read_experience_logs, put_back,
+                   put_latest)
+
+routes = Blueprint('routes', __name__)
+
+# e.g. redis://localhost:6379/0; default (or 'memory'): the sessions live and train in this process
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND')
+KEEPALIVE_SECONDS = 15  # Comment sent on idle action streams, so proxies keep them open and dead clients are noticed
+STREAM_POLL_SECONDS = 1  # How often an action stream checks that it wasn't replaced by a newer one
+
+# Set up by create_app, not at import time: the spawned processes of the BPM service and the learner import this
+# module again, and must not reset the model registry or start reapers and metric loggers of their own
+model_registry = None
+sessions = None
+metrics = get_metrics()
+
+
+def create_app():
+    """Sets up the sessions and metrics of this process and returns the app, e.g. gunicorn 'app:create_app()'."""
+    global model_registry, sessions
+    if SESSION_BACKEND is None or SESSION_BACKEND == 'memory':
+        model_registry = ModelRegistry()
+        sessions = SessionManager(model_registry=model_registry)
+    else:
+        # Any number of web server processes route the requests, training workers (training_worker.py) train the
+        # sessions
+        sessions = SessionManager(backend=make_backend(SESSION_BACKEND), train_locally=False)
+
+    metrics.register_gauge('image_queue_depth', lambda: [({'user_id': user_id}, images)
+                                                         for user_id, images, _ in sessions.queue_depths()])
+    metrics.register_gauge('action_queue_depth', lambda: [({'user_id': user_id}, actions)
+                                                          for user_id, _, actions in sessions.queue_depths()])
+    metrics.register_gauge('sessions', lambda: [({}, len(sessions))])
+    metrics.start_logging()
+
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    return app
+
+
+@routes.before_app_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@routes.after_app_request
+def record_request(response):
+    # For streamed responses this is the time until the stream starts. No user_id label: sessions end in the training
+    # worker, which can't forget the series of this process, so they would pile up
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        metrics.record_span('http_request', time.perf_counter() - g.request_started, route=route,
+                            status=response.status_code)
+    return response
+
+
+@routes.route('/')
 @error_handler
 def home():
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -23,78 +74,128 @@ def home():
     return render_template('index.html')
 
 
-@app.route('/welcome')
+@routes.route('/welcome')
 @error_handler
 @inner_content
 def welcome():
     return render_template('welcome.html')
 
 
-@app.route('/thanks/')
+@routes.route('/thanks/')
 @error_handler
 @inner_content
 def thanks():
     return render_template('thanks.html')
 
 
-@app.route('/experiment')
+@routes.route('/experiment')
 @error_handler
 @inner_content
 def experiment():
     return render_template('experiment.html')
 
 
-@app.route('/image', methods=['POST'])
+@routes.route('/image', methods=['POST'])
 def process_image():
-    data = request.get_json()
-    image_data = data['image']
-    user_id = data['user_id']
-    image = decode_image(image_data)
-    image_queues[user_id].put(image)
+    if request.mimetype == 'image/jpeg':
+        # Raw JPEG bytes in the body, user id in the query string
+        user_id = int(request.args['user_id'])
+        captured = request.args.get('t', type=float)
+        image = decode_image_bytes(request.get_data(), reduction=INGEST_REDUCTION)
+    else:
+        # JSON with a base64 data URL
+        data = request.get_json()
+        image_data = data['image']
+        user_id = data['user_id']
+        captured = data.get('t')
+        image = decode_image(image_data, reduction=INGEST_REDUCTION)
+    if image is None:
+        # An empty canvas blob or a corrupt JPEG, the next frame is probably fine
+        return make_response('Could not decode the image.', 400)
+    # Only queue the small tile the estimator needs, with the capture time (client clock, seconds) if it was sent
+    put_latest(sessions.get(user_id).image_queue, (reduce_frame(image), captured, time.time()))
     return ""
 
 
-@app.route('/action', methods=['GET'])
+@routes.route('/action', methods=['GET'])
 @error_handler
 @inner_content
 def get_action():
     user_id = int(request.args['user_id'])
-    next_action = action_queues[user_id].get()
+    action_queue = sessions.get(user_id).action_queue
+    if 'timeout' in request.args:
+        # Long-poll: answer with 204 No Content if nothing happened in time, the client asks again
+        try:
+            return action_queue.get(timeout=float(request.args['timeout']))
+        except Empty:
+            return make_response('', 204)
+    next_action = action_queue.get()
     return next_action
 
 
-@app.route('/session')
+@routes.route('/action/stream', methods=['GET'])
+@error_handler
+def stream_actions():
+    # Server-sent events: every action is pushed as soon as the environment puts it in the queue
+    user_id = int(request.args['user_id'])
+    action_queue = sessions.get(user_id).action_queue
+    # One stream per session: after a reconnect, the stream of the old connection must not take the next action
+    token = sessions.start_stream(user_id)
+
+    def events():
+        keepalive = time.monotonic() + KEEPALIVE_SECONDS
+        while sessions.stream_token(user_id) == token:
+            try:
+                next_action = action_queue.get(timeout=STREAM_POLL_SECONDS)
+            except Empty:
+                if time.monotonic() >= keepalive:
+                    yield ': keepalive\n\n'
+                    # Still connected, so the session isn't idle
+                    sessions.touch(user_id)
+                    keepalive = time.monotonic() + KEEPALIVE_SECONDS
+                continue
+            if sessions.stream_token(user_id) != token:
+                # A newer stream took over while this one waited, it gets the action
+                put_back(action_queue, next_action)
+                return
+            yield f'data: {next_action}\n\n'
+            if next_action == 'end':
+                return
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                     'X-Accel-Buffering': 'no'})
+
+
+@routes.route('/session')
 @error_handler
 def start():
-    global USER_ID_COUNTER
-    new_id = USER_ID_COUNTER
-    USER_ID_COUNTER += 1
-    action_queues[new_id] = Queue()
-    image_queues[new_id] = Queue()
-    clients[new_id] = ClientThread(user_id=new_id, action_queue=action_queues[new_id], image_queue=image_queues[new_id],
-                                   agent_queue=agent_queue)
-    clients[new_id].start()
+    new_id = sessions.create()
     return str(new_id)
 
 
-@app.route('/stop', methods=['GET'])
+@routes.route('/stop', methods=['GET'])
 @error_handler
 @inner_content
 def stop():
     user_id = int(request.args['user_id'])
-    clients[user_id].halt_learning()
+    sessions.stop(user_id)
     return ""
 
 
-@app.errorhandler(404)
+@routes.route('/metrics')
+def get_metrics_text():
+    # Prometheus text exposition format
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@routes.app_errorhandler(404)
 @error_handler
 def page_not_found(error):
     return redirect('/')
 
 
 if __name__ == '__main__':
-    create_initial_agent_queue(agent_queue)
-    # app.run(host='0.0.0.0', port=5000)
-    app.run()
+    # create_app().run(host='0.0.0.0', port=5000)
+    create_app().run()
 
 
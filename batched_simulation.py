@@ -0,0 +1,129 @@
+import gymnasium as gym
+import numpy as np
+from gymnasium.vector.utils import batch_space
+
+SONG_OPTIONS = {
+    'rock': 20,
+    'salsa': 15,
+    'classic': -15,
+    'meditation': -20,
+    'techno': 30
+}
+
+
+class BatchedHeartRateSimulation:
+    """Array version of simulation.HeartRateSimulation, advancing a whole batch of heart rates at once."""
+
+    def __init__(self):
+        self.min = 60
+        self.max = 150
+
+    def get_new_rates(self, start, change, rng):
+        change_var = change + (rng.random(len(start)) * 2) - 1  # variance of 1
+        alpha = np.where(change_var < 0,
+                         (start - self.min) / (self.max - self.min) * 0.8,
+                         (start - self.max) / (self.min - self.max) * 0.5)
+        new_rates = start + alpha * change_var
+        return np.clip(new_rates, self.min, self.max)
+
+
+def bpms_from_changes(changes, rng):
+    change_min = -50
+    change_max = 50
+    bpms = (changes - change_min) / (change_max - change_min) * 250 + 25
+    bpms += (rng.random(len(changes)) * 50) - 25
+    return bpms.astype(np.int64)
+
+
+class BatchedMusicEnv(gym.vector.VectorEnv):
+    """Steps num_envs copies of simulation.MusicEnv with one vectorized call.
+
+    The dynamics, rewards and episode ends are the same as the scalar environment. goal_heart_bpm can be a scalar
+    or one goal per environment, so goals and reward shapes can be swept in a single batch. Finished environments
+    are reset in the same step; their last observation is in info['final_obs']."""
+
+    metadata = {'autoreset_mode': gym.vector.AutoresetMode.SAME_STEP} if hasattr(gym.vector, 'AutoresetMode') else {}
+
+    def __init__(self, num_envs, goal_heart_bpm=60, max_steps=1000, songs_per_episode=10, start_heart_bpm=80,
+                 terminal_reward=100, truncation_reward=-1000, song_options=None):
+        song_options = SONG_OPTIONS if song_options is None else song_options
+        self.song_names = list(song_options.keys())
+        self.song_changes = np.array(list(song_options.values()), dtype=np.float64)
+        self.heart = BatchedHeartRateSimulation()
+
+        self.num_envs = num_envs
+        self.single_action_space = gym.spaces.Discrete(2)
+        self.single_observation_space = gym.spaces.Dict({'heart_bpm': gym.spaces.Discrete(300),
+                                                         'song_bpm': gym.spaces.Discrete(300)})
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+
+        self.goal = np.broadcast_to(np.asarray(goal_heart_bpm, dtype=np.float64), (num_envs,)).copy()
+        self.max_steps = max_steps
+        self.songs_per_episode = songs_per_episode
+        self.terminal_reward = terminal_reward
+        self.truncation_reward = truncation_reward
+
+        self.heart_rate = np.full(num_envs, start_heart_bpm, dtype=np.float64)
+        self.heart_bpm = np.zeros(num_envs, dtype=np.int64)
+        self.song_bpm = np.zeros(num_envs, dtype=np.int64)
+        self.next_song = np.zeros(num_envs, dtype=np.int64)
+        self.steps_left = np.zeros(num_envs, dtype=np.int64)
+        self.songs_left = np.zeros(num_envs, dtype=np.int64)
+        self.np_random = np.random.default_rng()
+
+    def reset(self, seed=None, options=None):
+        if seed is not None:
+            self.np_random = np.random.default_rng(seed)
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        return self.observation(), {}
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        previous_heart_bpm = self.heart_bpm.copy()
+
+        # Pick yes: the current song plays and changes the heart rate
+        yes = actions == 0
+        self.songs_left[yes] -= 1
+        self.heart_rate[yes] = self.heart.get_new_rates(self.heart_rate[yes], self.song_changes[self.next_song[yes]],
+                                                        self.np_random)
+        self.heart_bpm[yes] = self.heart_rate[yes].astype(np.int64)
+        # Both actions move on to a new song
+        self.set_next_songs(np.ones(self.num_envs, dtype=bool))
+
+        # Calculate reward
+        rewards = distance(previous_heart_bpm, self.goal) - distance(self.heart_bpm, self.goal)
+
+        terminated = self.songs_left == 0
+        rewards[terminated] = self.terminal_reward - distance(self.heart_rate[terminated], self.goal[terminated])
+
+        self.steps_left -= 1
+        truncated = self.steps_left <= 0
+        rewards[truncated] = self.truncation_reward
+
+        info = {}
+        done = terminated | truncated
+        if done.any():
+            info['final_obs'] = self.observation()
+            info['_final_obs'] = done
+            self.reset_envs(done)
+        return self.observation(), rewards, terminated, truncated, info
+
+    def reset_envs(self, mask):
+        # The heart rate carries over between episodes, like in the scalar environment
+        self.set_next_songs(mask)
+        self.heart_bpm[mask] = self.heart_rate[mask].astype(np.int64)
+        self.steps_left[mask] = self.max_steps
+        self.songs_left[mask] = self.songs_per_episode
+
+    def set_next_songs(self, mask):
+        count = int(mask.sum())
+        self.next_song[mask] = self.np_random.integers(len(self.song_names), size=count)
+        self.song_bpm[mask] = bpms_from_changes(self.song_changes[self.next_song[mask]], self.np_random)
+
+    def observation(self):
+        return {'heart_bpm': self.heart_bpm.copy(), 'song_bpm': self.song_bpm.copy()}
+
+
+def distance(x, y):
+    return np.abs(x - y)
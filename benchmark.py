@@ -0,0 +1,275 @@
+import argparse
+import base64
+import json
+import os
+import platform
+import queue
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import wave
+
+import cv2
+import numpy as np
+
+BASELINE_FILE = 'benchmark_baseline.json'
+REGRESSION_THRESHOLD = 0.25  # Slowdown (relative to the baseline) that counts as a regression
+SEED = 0
+JPEG_QUALITY = 92  # Quality of canvas.toBlob / canvas.toDataURL in browsers
+
+
+def timed(function, repeat=5, number=1):
+    """Returns the median seconds per call of function over repeat rounds of number calls."""
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - start) / number)
+    return statistics.median(rounds)
+
+
+def synthetic_frame(width=640, height=480, pulse=0.0, rng=None):
+    # Smooth "face" blob on a noisy background, brightened by the pulse
+    rng = rng or np.random.default_rng(SEED)
+    y, x = np.mgrid[0:height, 0:width]
+    blob = np.exp(-(((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 3)) ** 2))
+    frame = 90 + 100 * blob[..., None] * np.array([0.8, 0.9, 1.0]) + 2 * pulse + rng.normal(0, 4, (height, width, 3))
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def synthetic_song(filename, seconds=30, sampling_rate=22050, bpm=120):
+    # Chord with clicks on the beat, as 16-bit mono WAV
+    t = np.arange(int(seconds * sampling_rate)) / sampling_rate
+    signal = sum(0.2 * np.sin(2 * np.pi * frequency * t) for frequency in (261.63, 329.63, 392.0))
+    beats = (t * bpm / 60) % 1 < 0.02
+    signal = np.clip(signal + 0.5 * beats, -1, 1)
+    with wave.open(filename, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sampling_rate)
+        file.writeframes((signal * 32767).astype(np.int16).tobytes())
+
+
+def benchmark_decode_image(quick):
+    from image_bpm import INGEST_REDUCTION
+    from utils import decode_image, decode_image_bytes
+
+    jpg_data = cv2.imencode('.jpg', synthetic_frame(), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes()
+    data_url = 'data:image/jpeg;base64,' + base64.b64encode(jpg_data).decode('ascii')
+    number = 20 if quick else 200
+    return {'data_url_full': timed(lambda: decode_image(data_url), number=number),
+            'jpeg_full': timed(lambda: decode_image_bytes(jpg_data), number=number),
+            'jpeg_reduced': timed(lambda: decode_image_bytes(jpg_data, reduction=INGEST_REDUCTION), number=number)}
+
+
+def benchmark_image_bpm(quick):
+    """Seconds per frame of the BPMService fed by 1, 8 and 64 concurrent sessions of timestamped frames, until every
+    session has the estimate of its window, and seconds per estimate of a full window."""
+    from bpm_service import BPMService
+    from image_bpm import FPS, INGEST_REDUCTION
+
+    rng = np.random.default_rng(SEED)
+    # Frames as /image decodes them: at the ingest reduction, with a 72 BPM pulse
+    frames = [cv2.resize(synthetic_frame(pulse=np.sin(2 * np.pi * 1.2 * i / FPS), rng=rng),
+                         (640 // INGEST_REDUCTION, 480 // INGEST_REDUCTION), interpolation=cv2.INTER_AREA)
+              for i in range(2 * FPS)]
+    frames_per_session = 100 if quick else 300
+    duration = frames_per_session / FPS
+    results = dict()
+    for streams in (1, 8, 64):
+        service = BPMService()
+        try:
+            queues = [queue.Queue() for _ in range(streams)]
+            sessions = [service.register(image_queue) for image_queue in queues]
+            # Captured at FPS from start on and received 50 ms later, like a browser in real time
+            start = time.time()
+            for session in sessions:
+                session.start_window(start)
+            started = time.perf_counter()
+            for i in range(frames_per_session):
+                for image_queue in queues:
+                    image_queue.put((frames[i % len(frames)], start + i / FPS, start + i / FPS + 0.05))
+            for session in sessions:
+                session.wait_for_window(duration)
+            results[f'streams_{streams}'] = (time.perf_counter() - started) / (streams * frames_per_session)
+        finally:
+            service.shutdown()
+
+    # The estimate is computed when it is read, so drop the cached one before every read
+    window = sessions[0].window
+
+    def estimate():
+        window.cached_bpm = None
+        return window.bpm
+
+    results['window_estimate'] = timed(estimate, number=100 if quick else 1000)
+    return results
+
+
+def benchmark_compute_features(quick):
+    """Cold analysis with librosa against warm hits of the feature cache (memory and disk)."""
+    import feature_cache
+    import song_bpm_utils
+    import song_catalog
+
+    directory = tempfile.mkdtemp()
+    song_directory = os.path.join(directory, 'audio')
+    os.makedirs(os.path.join(song_directory, 'benchmark'))
+    synthetic_song(os.path.join(song_directory, 'benchmark', 'song.wav'))
+    song = 'benchmark/song.wav'
+    # Point the song library at the synthetic song
+    original_directories = song_bpm_utils.SONG_DIRECTORY, song_catalog.SONG_DIRECTORY, feature_cache.SONG_DIRECTORY
+    song_bpm_utils.SONG_DIRECTORY = song_catalog.SONG_DIRECTORY = feature_cache.SONG_DIRECTORY = song_directory
+    song_catalog._catalog = None
+    try:
+        cache = feature_cache.FeatureCache(cache_directory=os.path.join(directory, 'features'))
+        cache.get(song, duration_seconds=20)
+        return {'cold': timed(lambda: song_bpm_utils.compute_features(song, duration_seconds=20),
+                              repeat=1 if quick else 3),
+                'warm_memory': timed(lambda: cache.get(song, duration_seconds=20), number=100),
+                'warm_disk': timed(lambda: feature_cache.FeatureCache(cache.cache_directory).get(
+                    song, duration_seconds=20), number=10 if quick else 50)}
+    finally:
+        song_bpm_utils.SONG_DIRECTORY, song_catalog.SONG_DIRECTORY, feature_cache.SONG_DIRECTORY = \
+            original_directories
+        song_catalog._catalog = None
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchmark_music_library(quick):
+    from music_library import MusicLibrary
+
+    rng = random.Random(SEED)
+    results = dict()
+    for size in (10000, 100000):
+        songs = [f'category{i % 5}/song{i}.mp3' for i in range(size)]
+        song_bpms = {song: rng.randint(60, 180) for song in songs}
+        library = MusicLibrary(song_bpms=song_bpms, song_list=songs)
+        number = 200 if quick else 2000
+        results[f'init_{size}'] = timed(lambda: MusicLibrary(song_bpms=song_bpms, song_list=songs), repeat=3)
+        results[f'random_{size}'] = timed(library.get_random_song, number=number)
+        results[f'category_{size}'] = timed(lambda: library.get_random_song(category_weights={'category0': 2,
+                                                                                             'category1': 1}),
+                                            number=number)
+        results[f'bpm_stratified_{size}'] = timed(lambda: library.get_random_song(bpm_stratified=True),
+                                                  number=number)
+    return results
+
+
+def benchmark_simulation(quick):
+    """Seconds per step of the simulated environment, with and without the in-memory experience log."""
+    from simulation import MusicEnv
+
+    results = dict()
+    steps = 2000 if quick else 20000
+    for log_experience in (False, True):
+        env = MusicEnv(log_experience=log_experience)
+        env.reset(seed=SEED)
+        rng = random.Random(SEED)
+
+        def run():
+            for _ in range(steps):
+                _, _, terminated, truncated, _ = env.step(rng.randint(0, 1))
+                if terminated or truncated:
+                    env.reset()
+
+        results['step_logged' if log_experience else 'step'] = timed(run, repeat=3) / steps
+    return results
+
+
+def benchmark_ppo_inference(quick):
+    """Latency of one PPO action on the observations of MusicEnv, in both observation modes."""
+    import torch
+    from stable_baselines3 import PPO
+
+    from feature_extractors import observation_policy_kwargs
+    from learner import SpacesEnv
+    from model_registry import AGENT_KWARGS, AGENT_POLICY
+    from music_env import music_observation_space
+
+    torch.manual_seed(SEED)
+    results = dict()
+    for observation_mode, time_pooling in (('padded', 1), ('compact', 1), ('compact', 4)):
+        observation_space = music_observation_space(observation_mode=observation_mode, time_pooling=time_pooling)
+        observation_space.seed(SEED)
+        agent = PPO(AGENT_POLICY, SpacesEnv(observation_space), device='cpu', seed=SEED,
+                    policy_kwargs=observation_policy_kwargs(observation_mode), **{**AGENT_KWARGS, 'verbose': 0})
+        observation = observation_space.sample()
+        name = observation_mode if time_pooling == 1 else f'{observation_mode}_pooled_{time_pooling}'
+        results[name] = timed(lambda: agent.predict(observation, deterministic=True), number=20 if quick else 200)
+    return results
+
+
+BENCHMARKS = {'decode_image': benchmark_decode_image,
+              'image_bpm': benchmark_image_bpm,
+              'compute_features': benchmark_compute_features,
+              'music_library': benchmark_music_library,
+              'simulation': benchmark_simulation,
+              'ppo_inference': benchmark_ppo_inference}
+
+
+def run_benchmarks(names=None, quick=False):
+    """Returns the seconds per operation of every case of the selected benchmarks, as {'benchmark/case': seconds}."""
+    results = dict()
+    for name in names or BENCHMARKS:
+        print(f'Running {name}...', flush=True)
+        try:
+            cases = BENCHMARKS[name](quick)
+        except ImportError as error:
+            print(f'Skipped {name}: {error}')
+            continue
+        for case, seconds in cases.items():
+            results[f'{name}/{case}'] = seconds
+    return results
+
+
+def find_regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # (case, baseline seconds, seconds) of the cases that got more than threshold slower
+    return [(case, baseline[case], seconds) for case, seconds in results.items()
+            if case in baseline and seconds > baseline[case] * (1 + threshold)]
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'system': platform.system(), 'cpus': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic inputs.')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline results (JSON)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='relative slowdown that counts as a regression')
+    parser.add_argument('--quick', action='store_true', help='fewer repetitions, less accurate')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+
+    results = run_benchmarks(args.benchmarks, quick=args.quick)
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+
+    print(f'\n{"case":40} {"seconds/op":>12} {"ops/s":>12} {"baseline":>12}')
+    for case, seconds in results.items():
+        reference = f'{baseline[case]:12.3g}' if case in baseline else f'{"-":>12}'
+        print(f'{case:40} {seconds:12.3g} {1 / seconds:12.4g} {reference}')
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for case, reference, seconds in regressions:
+        print(f'REGRESSION {case}: {seconds:.3g} s/op, baseline {reference:.3g} s/op '
+              f'({seconds / reference - 1:+.0%})')
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({'environment': environment(), 'time': time.time(), 'results': {**baseline, **results}},
+                      file, indent=2)
+        print(f'Saved the results in {args.baseline}.')
+    sys.exit(1 if regressions else 0)
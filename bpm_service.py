@@ -0,0 +1,89 @@
+import threading
+
+from image_bpm import BPMSource, reduce_frames
+from session_backend import get_many, wait_for_items
+
+FRAMES_PER_SESSION = 16  # Maximum number of frames taken from one session per batch, so no session starves the others
+WAIT_SECONDS = 0.5  # Longest wait for frames, after which new sessions and shutdown are noticed
+
+
+class SessionBPM(BPMSource):
+    """Heart rate estimate of one session, fed by the shared BPMService."""
+
+    def __init__(self, image_queue, user_id=None):
+        super().__init__(user_id=user_id)
+        self.image_queue = image_queue
+
+
+class BPMService:
+    """Estimates the heart rate of many sessions with one dispatcher thread.
+
+    The thread drains the image queues of all registered sessions, reduces the frames of the whole batch to their
+    mean intensity and feeds the means to the estimator of each session, in arrival order. The queued frames are
+    already reduced to small tiles at ingest, so this takes microseconds per frame and needs no worker processes.
+    When all queues are empty it blocks until a frame arrives (see session_backend.wait_for_items)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def register(self, image_queue, user_id=None):
+        session = SessionBPM(image_queue, user_id)
+        with self.lock:
+            self.sessions.append(session)
+        return session
+
+    def release(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                sessions = list(self.sessions)
+            frames, owners = self.collect(sessions)
+            if len(frames) == 0:
+                taken = wait_for_items([session.image_queue for session in sessions], WAIT_SECONDS)
+                if taken is None:
+                    continue
+                index, (frame, captured, received) = taken
+                frames, owners = [frame], [(sessions[index], captured, received)]
+
+            try:
+                values = reduce_frames(frames)
+            except Exception as error:
+                print(f'Could not process frames: {error}')
+                continue
+
+            for (session, captured, received), value in zip(owners, values):
+                session.push(value, captured, received)
+
+    def collect(self, sessions):
+        frames, owners = [], []
+        for session, items in zip(sessions, get_many([session.image_queue for session in sessions],
+                                                     FRAMES_PER_SESSION)):
+            for frame, captured, received in items:
+                frames.append(frame)
+                owners.append((session, captured, received))
+        return frames, owners
+
+    def shutdown(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+_bpm_service = None
+_bpm_service_lock = threading.Lock()
+
+
+def get_bpm_service():
+    """Returns the process-wide BPM service, starting it on first use."""
+    global _bpm_service
+    with _bpm_service_lock:
+        if _bpm_service is None:
+            _bpm_service = BPMService()
+        return _bpm_service
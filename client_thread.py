@@ -1,28 +1,48 @@
+import collections
+import copy
 import datetime
 import os
 import queue
 import threading
+import time
 
 import numpy as np
+import torch
 from stable_baselines3 import PPO
 from stable_baselines3.common.callbacks import BaseCallback
 from stable_baselines3.common.monitor import Monitor
 from stable_baselines3.common.results_plotter import load_results, ts2xy
 from stable_baselines3.common.callbacks import CheckpointCallback
+from stable_baselines3.common.save_util import recursive_getattr, save_to_zip_file
 
+from feature_extractors import observation_policy_kwargs
+from learner import get_learner, pack_rollout
+from metrics import get_metrics
+from model_registry import AGENT_KWARGS, AGENT_POLICY, agent_settings
 from music_env import MusicEnv
+from utils import put_latest
 
 LOG_DIR = 'static/logs'
+KEEP_CHECKPOINTS = 3  # Backups kept per session, older ones are removed
+OBSERVATION_MODE = 'padded'  # See music_env.OBSERVATION_MODES; saved agents only load into the mode they were made in
+TIME_POOLING = 1  # Chroma frames averaged into one in the 'compact' observation mode
+SONG_DURATION_SECONDS = 20
+# Compressed time for load tests: songs play (and frames are collected) for SONG_DURATION_SECONDS / TIME_SCALE; the
+# observations stay the same
+TIME_SCALE = float(os.environ.get('TIME_SCALE', 1))
 
 
 class ClientThread(threading.Thread):
-    def __init__(self, user_id, image_queue, action_queue, agent_queue):
+    def __init__(self, user_id, image_queue, action_queue, model_registry, use_learner=True):
         super().__init__()
         self.user_id = user_id
         self.image_queue = image_queue
         self.action_queue = action_queue
-        self.agent_queue = agent_queue
+        self.model_registry = model_registry
+        self.use_learner = use_learner  # Train in the shared learner process instead of on this thread
         self.callback = None
+        self.env = None
+        self.stop_requested = False
 
     def run(self):
         # Create log dir
@@ -30,17 +50,21 @@ class ClientThread(threading.Thread):
         os.makedirs(log_dir, exist_ok=True)
 
         # Create and wrap the environment
-        env = MusicEnv(image_queue=self.image_queue, song_queue=self.action_queue, song_duration_seconds=20,
-                       songs_per_episode=10, log_dir=log_dir)
+        env = MusicEnv(image_queue=self.image_queue, song_queue=self.action_queue,
+                       song_duration_seconds=SONG_DURATION_SECONDS, songs_per_episode=10, log_dir=log_dir,
+                       observation_mode=OBSERVATION_MODE, time_pooling=TIME_POOLING, user_id=self.user_id,
+                       playback_seconds=SONG_DURATION_SECONDS / TIME_SCALE)
+        self.env = env
+        if self.stop_requested:
+            env.halt()
         env = Monitor(env, log_dir)
 
-        try:
-            # See if there is a saved agent that can be loaded
-            old_agent_file = self.agent_queue.get_nowait()
-            agent = PPO.load(old_agent_file, env=env)
-        except queue.Empty:
+        # See if there is a saved agent that can be loaded
+        policy_kwargs = observation_policy_kwargs(OBSERVATION_MODE)
+        agent, old_agent_file = self.model_registry.load_agent(env, policy_kwargs=policy_kwargs)
+        if agent is None:
             # If there is no saved agent, make a new agent
-            agent = PPO("MultiInputPolicy", env, verbose=1, n_steps=32, batch_size=16, tensorboard_log=log_dir)
+            agent = PPO(AGENT_POLICY, env, tensorboard_log=log_dir, policy_kwargs=policy_kwargs, **AGENT_KWARGS)
 
         # Create the callback: save every 33 steps
         # (ranges anywhere between 0 and 11 minutes depending on agent's actions)
@@ -49,19 +73,87 @@ class ClientThread(threading.Thread):
             save_path=log_dir,
             name_prefix="backup",
             save_vecnormalize=True,
+            asynchronous=True,
+            keep_last=KEEP_CHECKPOINTS,
+            user_id=self.user_id,
         )
+        if self.stop_requested:
+            # Stop was requested while the environment and agent were being set up
+            self.callback.stop()
 
         # Train the agent
-        agent.learn(total_timesteps=1000000000, callback=self.callback, reset_num_timesteps=False)
+        if self.use_learner:
+            self.act(agent, env, log_dir)
+        else:
+            agent.learn(total_timesteps=1000000000, callback=self.callback, reset_num_timesteps=False)
 
         # Stop the experiment
         env.close()  # Puts lasts "end" action in action queue (to stop the experiment client-side) & saves experiences
 
-        # Save the agent and put the file on the stack for future use
+        # Save the agent and register the file for future use
         agent.save(os.path.join(log_dir, "last_model"))
-        self.agent_queue.put(os.path.join(log_dir, "last_model")+".zip")
+        self.model_registry.register(os.path.join(log_dir, "last_model")+".zip", agent=agent, parent=old_agent_file)
+        get_metrics().forget(user_id=self.user_id)
+
+    def act(self, agent, env, log_dir):
+        """Plays songs with the current policy and leaves the PPO updates to the learner process.
+
+        Every n_steps transitions are submitted as a rollout; the parameters the learner publishes are copied into the
+        agent before the next step. Returns once the callback stops, with the agent holding the final parameters."""
+        learner = get_learner()
+        metrics = get_metrics()
+        learner.register(self.user_id, agent.get_parameters(), log_dir, observation_space=env.observation_space,
+                         policy_class=agent.policy_class, settings=agent_settings(agent))
+        policy = agent.policy
+        policy.set_training_mode(False)
+        self.callback.init_callback(agent)
+
+        steps = []
+        observation, _ = env.reset()
+        episode_start = True
+        while True:
+            parameters = learner.latest_parameters(self.user_id)
+            if parameters is not None:
+                with metrics.span('apply_parameters', user_id=self.user_id):
+                    agent.set_parameters(parameters)
+
+            with torch.no_grad(), metrics.span('policy_inference', user_id=self.user_id):
+                observation_tensor, _ = policy.obs_to_tensor(observation)
+                action, value, log_prob = policy(observation_tensor)
+            next_observation, reward, terminated, truncated, _ = env.step(int(action[0]))
+            agent.num_timesteps += 1
+            if truncated and not terminated:
+                # Bootstrap with the value of the last observation, like SB3 does for time limits
+                with torch.no_grad():
+                    reward += agent.gamma * policy.predict_values(policy.obs_to_tensor(next_observation)[0]).item()
+            steps.append(({key: tensor[0].cpu().numpy() for key, tensor in observation_tensor.items()},
+                          int(action[0]), reward, episode_start, value.item(), log_prob.item()))
+            episode_start = terminated or truncated
+            if episode_start:
+                next_observation, _ = env.reset()
+            observation = next_observation
+
+            if len(steps) == agent.n_steps:
+                with torch.no_grad():
+                    last_value = policy.predict_values(policy.obs_to_tensor(observation)[0]).item()
+                learner.submit(self.user_id, pack_rollout(steps, last_value, episode_start))
+                steps = []
+
+            if not self.callback.on_step():
+                break
+        self.callback.on_training_end()
+
+        # Wait for the updates of the rollouts that were submitted
+        with metrics.span('learner_release', user_id=self.user_id):
+            parameters = learner.release(self.user_id)
+        if parameters is not None:
+            agent.set_parameters(parameters)
 
     def halt_learning(self):
+        self.stop_requested = True
+        if self.env is not None:
+            # Don't keep waiting for images that won't come
+            self.env.halt()
         if self.callback is not None:
             self.callback.stop()
 
@@ -99,21 +191,109 @@ class SaveOnBestTrainingRewardCallback(BaseCallback):
 
 
 class CancellableCheckpointCallback(CheckpointCallback):
+    """Checkpoint callback that can be stopped from another thread.
+
+    Checkpoints are written to a temporary file and then renamed, so a crash never leaves a partial zip. In
+    asynchronous mode the training thread only copies the policy state in memory and a background thread writes the
+    zip; if the writer falls behind, only the newest pending checkpoint is kept. With keep_last, older checkpoints of
+    this callback are removed."""
+
     def __init__(self,
                  save_freq: int,
                  save_path: str,
                  name_prefix: str = "rl_model",
                  save_replay_buffer: bool = False,
                  save_vecnormalize: bool = False,
-                 verbose: int = 0):
+                 verbose: int = 0,
+                 asynchronous: bool = False,
+                 keep_last: int = None,
+                 user_id=None):
         super().__init__(save_freq=save_freq, save_path=save_path, name_prefix=name_prefix,
                          save_replay_buffer=save_replay_buffer, save_vecnormalize=save_vecnormalize, verbose=verbose)
         self.stop_requested = False
+        self.asynchronous = asynchronous
+        self.keep_last = keep_last
+        self.saved_paths = collections.deque()
+        self.pending = queue.Queue(maxsize=1)
+        self.writer = None
+        self.user_id = user_id  # Label of the metrics
+        self.metrics = get_metrics()
+        self.rollout_ended = None
 
     def _on_step(self) -> bool:
         if self.stop_requested:
             return False
-        return super()._on_step()
+        if self.n_calls % self.save_freq == 0:
+            self.save_checkpoint()
+        return True
+
+    def _on_rollout_end(self) -> None:
+        self.rollout_ended = time.perf_counter()
+
+    def _on_rollout_start(self) -> None:
+        # When agent.learn() trains on this thread, the PPO update runs between two rollouts
+        if self.rollout_ended is not None:
+            self.metrics.record_span('ppo_update', time.perf_counter() - self.rollout_ended, user_id=self.user_id)
+            self.rollout_ended = None
+
+    def _on_training_end(self) -> None:
+        # Wait until the last checkpoint has been written
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
 
     def stop(self):
         self.stop_requested = True
+
+    def save_checkpoint(self):
+        model_path = self._checkpoint_path(extension="zip")
+        with self.metrics.span('checkpoint_snapshot', user_id=self.user_id):
+            snapshot = self.snapshot()
+        if self.asynchronous:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_pending, daemon=True)
+                self.writer.start()
+            put_latest(self.pending, (model_path, snapshot))
+        else:
+            self.write(model_path, snapshot)
+
+        if self.save_replay_buffer and hasattr(self.model, "replay_buffer") and self.model.replay_buffer is not None:
+            self.model.save_replay_buffer(self._checkpoint_path("replay_buffer_", extension="pkl"))
+        if self.save_vecnormalize and self.model.get_vec_normalize_env() is not None:
+            self.model.get_vec_normalize_env().save(self._checkpoint_path("vecnormalize_", extension="pkl"))
+
+    def snapshot(self):
+        # Copy of everything model.save() writes, so training can go on while it is written
+        data = self.model.__dict__.copy()
+        exclude = set(self.model._excluded_save_params())
+        state_dicts_names, torch_variable_names = self.model._get_torch_save_params()
+        for torch_var in state_dicts_names + torch_variable_names:
+            exclude.add(torch_var.split(".")[0])
+        for param_name in exclude:
+            data.pop(param_name, None)
+        pytorch_variables = {name: recursive_getattr(self.model, name) for name in torch_variable_names}
+        return {'data': copy.deepcopy(data), 'params': copy.deepcopy(self.model.get_parameters()),
+                'pytorch_variables': copy.deepcopy(pytorch_variables)}
+
+    def write_pending(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            self.write(*item)
+
+    def write(self, model_path, snapshot):
+        tmp_path = model_path + '.tmp'
+        with self.metrics.span('checkpoint_write', user_id=self.user_id), open(tmp_path, 'wb') as file:
+            save_to_zip_file(file, **snapshot)
+        os.replace(tmp_path, model_path)
+        if self.verbose >= 2:
+            print(f"Saving model checkpoint to {model_path}")
+
+        self.saved_paths.append(model_path)
+        while self.keep_last is not None and len(self.saved_paths) > self.keep_last:
+            try:
+                os.remove(self.saved_paths.popleft())
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,161 @@
+import csv
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+FLUSH_SIZE = 64  # Records kept in memory before they are handed to the writer
+FILE_NAME_DTYPE = 'U256'
+
+
+class ExperienceRecorder:
+    """Streams experiences to a CSV file.
+
+    Records are stored in a preallocated structured array; full buffers are written by a background thread, so a
+    crash only loses the records of the current buffer. Columns are (name, dtype) pairs; string columns are written
+    quoted, object columns (e.g. rewards that can be int or float) as they are."""
+
+    def __init__(self, filename, columns, metadata=None, capacity=FLUSH_SIZE):
+        self.filename = filename
+        self.dtype = np.dtype(columns)
+        self.quoted = [self.dtype[name].kind == 'U' for name in self.dtype.names]
+        self.capacity = capacity
+        self.buffer = np.empty(capacity, dtype=self.dtype)
+        self.size = 0
+
+        # Write the metadata and the header right away, so the file exists from the start of the session
+        with open(self.filename, 'w') as file:
+            if metadata is not None:
+                file.write(f'#{json.dumps(metadata)}\n')
+            file.write(','.join(self.dtype.names) + '\n')
+
+        self.batches = queue.Queue()
+        self.writer = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer.start()
+
+    def record(self, *values):
+        self.buffer[self.size] = values
+        self.size += 1
+        if self.size == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+        self.batches.put(self.buffer[:self.size])
+        self.buffer = np.empty(self.capacity, dtype=self.dtype)
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+
+    def write_batches(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            with open(self.filename, 'a') as file:
+                file.writelines(self.format_row(row) for row in batch.tolist())
+
+    def format_row(self, row):
+        return ','.join(f'"{value}"' if quoted else f'{value}' for value, quoted in zip(row, self.quoted)) + '\n'
+
+
+# Columns shared by the experience logs of the real and the simulated environment
+LOG_COLUMNS = {'heart_bpm': np.int32, 'song_file': str, 'a': np.int8, 'r': np.float64, 'next_heart_bpm': np.int32,
+               'next_song_file': str, 'terminated': bool, 'truncated': bool}
+
+
+def parse_experience_log(filename):
+    """Returns the metadata (None if the file has no metadata line) and the columns of one experience log."""
+    metadata = None
+    with open(filename, newline='') as file:
+        first_line = file.readline()
+        if first_line.startswith('#'):
+            metadata = json.loads(first_line[1:])
+        else:
+            file.seek(0)
+        rows = list(csv.reader(file)) or [list(LOG_COLUMNS)]
+    header, rows = rows[0], [row for row in rows[1:] if len(row) == len(rows[0])]
+    columns = dict()
+    for name, dtype in LOG_COLUMNS.items():
+        values = [row[header.index(name)] for row in rows]
+        if dtype is bool:
+            columns[name] = np.array([value == 'True' for value in values], dtype=bool)
+        elif dtype is str:
+            columns[name] = np.array(values, dtype=str)
+        else:
+            columns[name] = np.array(values, dtype=np.float64).astype(dtype)
+    return metadata, columns
+
+
+class ExperienceLogs:
+    """Experiences of many sessions in one set of columns. Row i belongs to session sessions[session[i]]."""
+
+    def __init__(self, sessions, metadata, columns, mtimes=None):
+        self.sessions = sessions  # Experience log file of every session
+        self.metadata = metadata
+        self.columns = columns
+        self.mtimes = mtimes  # Modification times of the log files when they were read
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns['session'])
+
+    def episodes(self):
+        # Episode number of every row, unique over all sessions
+        session = self.columns['session']
+        done = self.columns['terminated'] | self.columns['truncated']
+        new_episode = np.ones(len(session), dtype=bool)
+        new_episode[1:] = done[:-1] | (session[1:] != session[:-1])
+        return np.cumsum(new_episode) - 1
+
+    def reward_per_episode(self):
+        """Returns the session index and the total reward of every episode."""
+        episodes = self.episodes()
+        rewards = np.bincount(episodes, weights=self.columns['r'])
+        sessions = np.zeros(len(rewards), dtype=np.int32)
+        sessions[episodes] = self.columns['session']
+        return sessions, rewards
+
+    def heart_bpm_delta_per_song(self):
+        """Returns the songs that were played and the mean heart BPM change while they played."""
+        played = self.columns['a'] == 0
+        deltas = (self.columns['next_heart_bpm'] - self.columns['heart_bpm'])[played]
+        return group_mean(self.columns['song_file'][played], deltas)
+
+    def category_effects(self):
+        """Returns the song categories and the mean heart BPM change of a song of that category."""
+        played = self.columns['a'] == 0
+        deltas = (self.columns['next_heart_bpm'] - self.columns['heart_bpm'])[played]
+        categories = np.char.partition(self.columns['song_file'][played], '/')[:, 0]
+        return group_mean(categories, deltas)
+
+    def save(self, directory):
+        # One .npy file per column, so they can be memory-mapped when loading
+        os.makedirs(directory, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(directory, f'{name}.npy'), column)
+        with open(os.path.join(directory, 'sessions.json'), 'w') as file:
+            json.dump({'sessions': self.sessions, 'metadata': self.metadata, 'mtimes': self.mtimes}, file)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'sessions.json')) as file:
+            index = json.load(file)
+        columns = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+                   for name in ['session', *LOG_COLUMNS]}
+        return cls(index['sessions'], index['metadata'], columns, mtimes=index['mtimes'])
+
+
+def group_mean(keys, values):
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    sums = np.bincount(inverse, weights=values, minlength=len(unique_keys))
+    return unique_keys, sums / np.maximum(counts, 1)
@@ -0,0 +1,96 @@
+import collections
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from song_bpm_utils import compute_features, SONG_DIRECTORY
+from song_catalog import get_catalog
+
+CACHE_DIRECTORY = 'static/cache/features'
+MEMORY_CACHE_SIZE = 256
+
+
+class FeatureCache:
+    """Content-addressed store for song features, with an in-memory LRU in front of an on-disk .npz store.
+
+    Entries are keyed by song path, mtime and the analysis parameters, so an entry is only rebuilt when the
+    song file changes or the features are requested with different settings."""
+
+    def __init__(self, cache_directory=CACHE_DIRECTORY, max_size=MEMORY_CACHE_SIZE):
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+    def get(self, song_file_name, duration_seconds, sampling_rate=22050, hop_length=512):
+        key = self.key(song_file_name, duration_seconds, sampling_rate, hop_length)
+
+        # In-memory LRU
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        # On-disk store
+        features = self.load(key)
+        if features is None:
+            features = self.compute(song_file_name, duration_seconds, sampling_rate, hop_length)
+            self.save(key, features)
+
+        with self.lock:
+            self.memory[key] = features
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+        return features
+
+    def key(self, song_file_name, duration_seconds, sampling_rate, hop_length):
+        catalog = get_catalog()
+        if song_file_name in catalog:
+            mtime = catalog.mtime(song_file_name)
+        else:
+            mtime = os.stat(f'{SONG_DIRECTORY}/{song_file_name}').st_mtime_ns
+        description = f'{song_file_name}|{mtime}|{duration_seconds}|{sampling_rate}|{hop_length}'
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_directory, f'{key}.npz')
+
+    def load(self, key):
+        try:
+            with np.load(self.path(key)) as data:
+                return {'bpm': int(data['bpm']), 'chroma_stft': data['chroma_stft']}
+        except (OSError, KeyError, ValueError):
+            # Missing or unreadable entry, it will be recomputed
+            return None
+
+    def save(self, key, features):
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        tmp_path = self.path(key) + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez_compressed(file, bpm=np.int16(features['bpm']), chroma_stft=features['chroma_stft'])
+        os.replace(tmp_path, self.path(key))
+
+    @staticmethod
+    def compute(song_file_name, duration_seconds, sampling_rate=22050, hop_length=512):
+        features = compute_features(song_file_name, duration_seconds=duration_seconds, sampling_rate=sampling_rate,
+                                    hop_length=hop_length)
+        # Store the chroma as uint8 (0-255), which is the representation the environment observes
+        chroma_stft = np.round(features['chroma_stft'] * 255).astype(np.uint8)
+        return {'bpm': int(features['bpm']), 'chroma_stft': chroma_stft}
+
+
+_feature_cache = None
+_feature_cache_lock = threading.Lock()
+
+
+def get_feature_cache():
+    """Returns the process-wide feature cache, creating it on first use."""
+    global _feature_cache
+    with _feature_cache_lock:
+        if _feature_cache is None:
+            _feature_cache = FeatureCache()
+        return _feature_cache
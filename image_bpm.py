@@ -1,66 +1,259 @@
+import collections
+import threading
+import time
+
 import numpy as np
 import cv2
-import threading
-import collections
+
+from metrics import get_metrics
 
 WIDTH = 640
 HEIGHT = 480
 LEVELS = 3
 BUFFER_SIZE = 150
 FPS = 10
+TILE_WIDTH = WIDTH >> (LEVELS + 1)  # Width of the smallest pyramid level, the only one used for the estimate
+INGEST_REDUCTION = 8  # Frames are decoded at 1/8 scale, one pyrDown away from the tile
+RESYNC_INTERVAL = 1000  # Frames between full FFTs that reset the accumulated error of the sliding DFT
+MIN_WINDOW_SECONDS = 5  # Timestamped frames must cover this much of the window before there is an estimate
+# The browser stops capturing after the song, so the last frame of a window is up to a frame period (plus timer
+# jitter) short of its end. Frames that are missing at WINDOW_GRACE_SECONDS after the end are given up on.
+WINDOW_SLACK_SECONDS = 0.5
+WINDOW_GRACE_SECONDS = 5
 
 
-class ImageBPM(threading.Thread):
-    def __init__(self, image_queue):
-        super().__init__()
-        self.lock = threading.Lock()
+class BPMEstimator:
+    """Incremental version of the bandpassed FFT over the frame buffer.
 
-        self.image_queue = image_queue
+    The spatial mean of the real spectrum equals the real spectrum of the spatial mean, so every frame is reduced
+    to its mean intensity when it comes in. The masked frequency bins are then updated with a sliding DFT."""
 
-        self.gauss = collections.deque([], maxlen=BUFFER_SIZE)
-        self.bpm = 60.0
+    def __init__(self, buffer_size=BUFFER_SIZE, fps=FPS):
+        self.buffer_size = buffer_size
+        # Bandpass Filter for Specified Frequencies
+        self.frequencies = fps * np.arange(buffer_size) / buffer_size
+        mask = (self.frequencies >= 0.8) & (self.frequencies <= 2.5)  # 0.8 Hz to 2.5 Hz = 48 to 150 bpm
+        self.bins = np.flatnonzero(mask)
+        self.twiddles = np.exp(2j * np.pi * self.bins / buffer_size)
+
+        self.signal = np.zeros(buffer_size)  # Ring buffer of frame means
+        self.position = 0
+        self.count = 0
+        self.spectrum = np.zeros(len(self.bins), dtype=complex)
+        self.power = np.zeros(buffer_size)
 
+        self.bpm = 60.0
         self.values = []
 
-    def run(self):
-        # Bandpass Filter for Specified Frequencies
-        frequencies = FPS * np.arange(BUFFER_SIZE) / BUFFER_SIZE
-        mask = (frequencies >= 0.8) & (frequencies <= 2.5)          # 0.8 Hz to 2.5 Hz = 48 to 150 bpm
+    def push(self, value):
+        oldest = self.signal[self.position]
+        self.signal[self.position] = value
+        self.position = (self.position + 1) % self.buffer_size
+        self.count += 1
+
+        if self.count < self.buffer_size:
+            return None
+
+        if (self.count - self.buffer_size) % RESYNC_INTERVAL == 0:
+            # Full FFT over the buffer, oldest frame first
+            self.spectrum = np.fft.fft(np.roll(self.signal, -self.position))[self.bins]
+        else:
+            self.spectrum = (self.spectrum - oldest + value) * self.twiddles
+
+        # Grab a Pulse (bins outside of the bandpass stay zero)
+        self.power[self.bins] = self.spectrum.real
+        instant_hz = self.frequencies[np.argmax(self.power)]
+        instant_bpm = 60.0 * instant_hz
+
+        self.bpm = 0.95 * self.bpm + 0.05 * instant_bpm
+        self.values.append(self.bpm)
+        return self.bpm
+
+
+class WindowedBPMEstimator:
+    """Bandpassed FFT over timestamped frames.
+
+    The frame means are resampled onto a uniform grid at fps using their capture times, so network jitter and a lower
+    upload rate don't distort the frequency axis. Only frames captured after the start of the window are used, at most
+    the last buffer_size / fps seconds of them. The estimate is computed when it is read. Unlike BPMEstimator, it is
+    not smoothed with the previous estimates: each window measures the heart rate during one song on its own."""
 
-        while True:
-            frame = self.image_queue.get()
+    def __init__(self, buffer_size=BUFFER_SIZE, fps=FPS):
+        self.buffer_size = buffer_size
+        self.fps = fps
+        self.frequencies = fps * np.arange(buffer_size) / buffer_size
+        self.mask = (self.frequencies >= 0.8) & (self.frequencies <= 2.5)  # 0.8 Hz to 2.5 Hz = 48 to 150 bpm
+        self.times = collections.deque()
+        self.values = collections.deque()
+        self.cached_bpm = None
 
-            # Construct Gaussian Pyramid
-            self.gauss.append(self.buildGauss(frame, LEVELS+1)[-1])
+    def clear(self):
+        self.times.clear()
+        self.values.clear()
+        self.cached_bpm = None
 
-            if len(self.gauss) < BUFFER_SIZE:
-                continue
+    def push(self, value, timestamp):
+        if self.times and timestamp <= self.times[-1]:
+            return  # Duplicate or out of order
+        self.times.append(timestamp)
+        self.values.append(value)
+        while self.times[-1] - self.times[0] > self.buffer_size / self.fps:
+            self.times.popleft()
+            self.values.popleft()
+        self.cached_bpm = None
 
-            # Bandpass Filter
-            fourierTransform = np.real(np.fft.fft(self.gauss, axis=0))
-            fourierTransform[~mask] = 0
+    def duration(self):
+        return self.times[-1] - self.times[0] if self.times else 0.0
 
-            # Grab a Pulse
-            avg_per_timestep = [f.mean() for f in fourierTransform]
-            instant_hz = frequencies[np.argmax(avg_per_timestep)]
-            instant_bpm = 60.0 * instant_hz
+    @property
+    def bpm(self):
+        if self.cached_bpm is None and len(self.times) > 1:
+            times = np.array(self.times)
+            grid = np.arange(times[0], times[-1], 1 / self.fps)[-self.buffer_size:]
+            signal = np.interp(grid, times, np.array(self.values))
+            # Zero-padded to the buffer size, so the frequency bins are the same as for the full buffer. The magnitude
+            # (not the real part, which depends on the phase of the pulse) picks the bin
+            power = np.abs(np.fft.fft(signal - signal.mean(), n=self.buffer_size))
+            power[~self.mask] = 0
+            self.cached_bpm = 60.0 * self.frequencies[np.argmax(power)]
+        return self.cached_bpm
 
-            with self.lock:
-                self.bpm = 0.95 * self.bpm + 0.05 * instant_bpm
-                self.values.append(self.bpm)
-                # print('BPM', self.bpm)
+
+# Heart rate estimate, the number of frames it is based on (counted since the start) and when the last one came in
+Estimate = collections.namedtuple('Estimate', ['bpm', 'samples', 'timestamp'])
+
+
+class BPMSource:
+    """Heart rate estimate that can be waited on: every pushed frame updates the estimate and wakes the waiters.
+
+    Frames with a capture timestamp (client clock) go to a windowed estimator whose window is restarted with
+    start_window, e.g. at the start of every song. The client clock is mapped onto time.time() with the smallest
+    receive - capture offset seen, which is the one with the least network delay. The wall clock (rather than a
+    monotonic one) is used since frames may be received by a web server process on another host. Frames without a
+    timestamp use the rolling buffer of the sliding DFT."""
+
+    def __init__(self, buffer_size=BUFFER_SIZE, fps=FPS, user_id=None):
+        self.condition = threading.Condition()
+        self.user_id = user_id  # Label of the metrics
+        self.metrics = get_metrics()
+        self.fps = fps
+        self.estimator = BPMEstimator(buffer_size, fps)
+        self.window = WindowedBPMEstimator(buffer_size, fps)
+        self.samples = 0
+        self.timestamp = None
+        self.clock_offset = None
+        self.window_start = None
+        self.window_samples = 0
+        self.cancelled = False
+
+    def push(self, value, captured=None, received=None):
+        with self.condition:
+            if captured is None:
+                self.estimator.push(value)
+                self.timestamp = time.time()
+            else:
+                offset = (received if received is not None else time.time()) - captured
+                if self.clock_offset is None or offset < self.clock_offset:
+                    self.clock_offset = offset
+                self.timestamp = captured + self.clock_offset
+                if self.window_start is None or self.timestamp >= self.window_start:
+                    self.window.push(value, captured)
+            self.samples += 1
+            self.condition.notify_all()
+        self.metrics.increment('frames_ingested_total', user_id=self.user_id)
+        if received is not None:
+            # Time the frame spent between the /image request and the estimator
+            self.metrics.set_gauge('estimator_lag_seconds', time.time() - received, user_id=self.user_id)
+
+    def start_window(self, start=None):
+        """Only frames captured from start (time.time(), default now) on count for the timestamped estimate."""
+        with self.condition:
+            self.window_start = time.time() if start is None else start
+            self.window_samples = self.samples
+            self.window.clear()
 
     def getBPM(self):
-        with self.lock:
-            return self.bpm
+        with self.condition:
+            return self.estimate().bpm or 60.0
+
+    def getEstimate(self):
+        """Returns the current estimate; its bpm is None until there are enough frames."""
+        with self.condition:
+            return self.estimate()
+
+    def wait_for_estimate(self, since=0, min_samples=0, timeout=None):
+        """Waits until there is an estimate and at least min_samples frames came in after sample number since.
+
+        Returns the estimate, or None if that didn't happen within timeout seconds or the waits were cancelled."""
+        with self.condition:
+            ready = lambda: self.is_ready() and self.samples - since >= min_samples
+            if not self.condition.wait_for(lambda: ready() or self.cancelled, timeout) or not ready():
+                return None
+            return self.estimate()
+
+    def wait_for_window(self, duration, timeout=None):
+        """Waits until the frames of the first duration seconds of the window came in and there is an estimate.
+
+        Timestamped frames are judged by their capture time: the window is complete once they reach its end (less a
+        frame period and some slack), or WINDOW_GRACE_SECONDS after its end with the frames that came in. Other frames
+        are judged by their number at the nominal fps. Windows shorter than 2 * MIN_WINDOW_SECONDS need to be half
+        covered by frames instead of MIN_WINDOW_SECONDS.
+        Returns the estimate, or None if that didn't happen within timeout seconds or the waits were cancelled."""
+        def deadline():
+            if self.window_start is None:
+                return None
+            return self.window_start + duration + WINDOW_GRACE_SECONDS
+
+        def window_complete():
+            if self.window.times and self.window_start is None:
+                return self.window.duration() >= duration
+            if self.window.times:
+                return (self.timestamp >= self.window_start + duration - 1 / self.fps - WINDOW_SLACK_SECONDS
+                        or time.time() >= deadline())
+            return self.samples - self.window_samples >= duration * self.fps
+
+        with self.condition:
+            min_seconds = min(MIN_WINDOW_SECONDS, duration / 2)
+            end = None if timeout is None else time.time() + timeout
+            while not (self.is_ready(min_seconds) and window_complete()):
+                # Wake up for new frames, the deadline of the window, the timeout and cancel
+                now = time.time()
+                if self.cancelled or end is not None and now >= end:
+                    return None
+                wakeups = [moment - now for moment in (end, deadline()) if moment is not None and moment > now]
+                self.condition.wait(min(wakeups) if wakeups else None)
+            return self.estimate(min_seconds)
+
+    def cancel(self):
+        """Makes the current and all later waits return None at once, e.g. when the session stops."""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def is_ready(self, min_seconds=MIN_WINDOW_SECONDS):
+        if self.window.times:
+            return self.window.duration() >= min_seconds
+        return self.estimator.count >= self.estimator.buffer_size
+
+    def estimate(self, min_seconds=MIN_WINDOW_SECONDS):
+        # Condition must be held
+        if not self.is_ready(min_seconds):
+            return Estimate(None, self.samples, self.timestamp)
+        bpm = self.window.bpm if self.window.times else self.estimator.bpm
+        return Estimate(bpm, self.samples, self.timestamp)
+
 
-    # Helper Methods
-    def buildGauss(self, frame, levels):
-        pyramid = [frame]
+def reduce_frame(frame):
+    """Returns the smallest pyramid level of a frame. Frames that were already reduced at ingest need fewer levels."""
+    while frame.shape[1] > TILE_WIDTH:
+        frame = cv2.pyrDown(frame)
+    return frame
 
-        for level in range(levels):
-            frame = cv2.pyrDown(frame)
-            pyramid.append(frame)
 
-        return pyramid
+def reduce_frames(frames):
+    """Reduces a batch of frames to the mean intensity of their smallest pyramid level."""
+    tiles = [reduce_frame(frame) for frame in frames]
+    if tiles and all(tile.shape == tiles[0].shape for tile in tiles):
+        return np.stack(tiles).reshape(len(tiles), -1).mean(axis=1)
+    return np.array([tile.mean() for tile in tiles])
 
@@ -0,0 +1,218 @@
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+
+import cloudpickle
+import gymnasium as gym
+import numpy as np
+import torch
+from stable_baselines3 import PPO
+from stable_baselines3.common.logger import Logger, configure
+
+from metrics import get_metrics
+from model_registry import AGENT_KWARGS, AGENT_POLICY
+from music_env import music_observation_space
+
+RELEASE_TIMEOUT_SECONDS = 120  # How long a finished session waits for the updates of its last rollouts
+
+
+class SpacesEnv(gym.Env):
+    """Stands in for MusicEnv in the learner process: it only provides the spaces, transitions come from the actors.
+
+    Nothing should step it, but if something does, it returns a blank observation and truncates the episode."""
+
+    def __init__(self, observation_space=None):
+        self.action_space = gym.spaces.Discrete(2)
+        self.observation_space = observation_space if observation_space is not None else music_observation_space()
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        return blank_observation(self.observation_space), {}
+
+    def step(self, action):
+        return blank_observation(self.observation_space), 0.0, False, True, {}
+
+
+def blank_observation(space):
+    # Lowest valid observation of a (Dict of) Box and Discrete spaces
+    if isinstance(space, gym.spaces.Dict):
+        return {key: blank_observation(subspace) for key, subspace in space.spaces.items()}
+    if isinstance(space, gym.spaces.Discrete):
+        return space.start
+    return np.zeros(space.shape, dtype=space.dtype).clip(space.low, space.high).astype(space.dtype)
+
+
+class Learner:
+    """Runs the PPO updates of all sessions in a separate process.
+
+    The client threads only act: they collect rollouts of n_steps transitions with their own copy of the policy and
+    submit them. The learner process trains the agent of the session on every rollout it receives and publishes the
+    new parameters, which the client picks up before its next step. A gradient update therefore never delays the next
+    song, and one process serves all sessions."""
+
+    def __init__(self):
+        # Spawn the process so it doesn't inherit the threads (and locks) of the web server and the agents
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.updates = context.Queue()
+        self.lock = threading.Lock()
+        self.sessions = dict()  # Queue of published parameters of every registered session
+        self.process = context.Process(target=learn_forever, args=(self.requests, self.updates), daemon=True)
+        self.process.start()
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def register(self, user_id, parameters, log_dir=None, observation_space=None, policy_class=AGENT_POLICY,
+                 settings=None):
+        """Starts training a session from the given agent parameters (agent.get_parameters()).
+
+        The observation space (of the environment, default the padded MusicEnv one), the policy class and the settings
+        (model_registry.agent_settings, default AGENT_KWARGS) must be the ones of the agent, so the parameters fit and
+        the updates use its hyperparameters."""
+        with self.lock:
+            self.sessions[user_id] = queue.Queue()
+        # Settings can hold schedule functions that only cloudpickle can send
+        payload = cloudpickle.dumps((parameters, log_dir, observation_space, policy_class, settings))
+        self.requests.put(('register', user_id, payload))
+
+    def submit(self, user_id, rollout):
+        self.requests.put(('rollout', user_id, rollout))
+
+    def latest_parameters(self, user_id):
+        """Returns the newest parameters published for the session since the last call, or None."""
+        with self.lock:
+            updates = self.sessions[user_id]
+        parameters = None
+        while True:
+            try:
+                parameters, _ = updates.get_nowait()
+            except queue.Empty:
+                return parameters
+
+    def release(self, user_id, timeout=RELEASE_TIMEOUT_SECONDS):
+        """Stops training the session. Returns its parameters after all submitted rollouts, or None on a timeout or if
+        the learner could not set up the session."""
+        with self.lock:
+            updates = self.sessions[user_id]
+        self.requests.put(('release', user_id, None))
+        try:
+            while True:
+                parameters, final = updates.get(timeout=timeout)
+                if final:
+                    return parameters
+        except queue.Empty:
+            print(f'The learner did not release session {user_id} in time.')
+            return None
+        finally:
+            with self.lock:
+                del self.sessions[user_id]
+
+    def dispatch(self):
+        metrics = get_metrics()
+        while True:
+            user_id, parameters, final, train_seconds = self.updates.get()
+            if train_seconds:
+                metrics.record_span('ppo_update', train_seconds, user_id=user_id)
+            with self.lock:
+                updates = self.sessions.get(user_id)
+            if updates is not None:
+                updates.put((parameters, final))
+
+    def shutdown(self):
+        self.requests.put(('stop', None, None))
+
+
+def learn_forever(requests, updates):
+    agents = dict()
+    while True:
+        # Handle everything that arrived while the previous batch was training
+        messages = [requests.get()]
+        while True:
+            try:
+                messages.append(requests.get_nowait())
+            except queue.Empty:
+                break
+
+        trained = []
+        train_seconds = collections.defaultdict(float)
+        for kind, user_id, payload in messages:
+            if kind == 'stop':
+                return
+            if kind == 'register':
+                try:
+                    agents[user_id] = new_agent(*cloudpickle.loads(payload))
+                except Exception as error:
+                    # Report the failure as the final update, so release returns right away; other sessions go on
+                    print(f'Could not register session {user_id}: {error}')
+                    updates.put((user_id, None, True, 0.0))
+            elif kind == 'rollout' and user_id in agents:
+                started = time.perf_counter()
+                try:
+                    train(agents[user_id], payload)
+                except Exception as error:
+                    print(f'Could not train session {user_id}: {error}')
+                    continue
+                train_seconds[user_id] += time.perf_counter() - started
+                if user_id not in trained:
+                    trained.append(user_id)
+            elif kind == 'release':
+                agent = agents.pop(user_id, None)
+                if user_id in trained:
+                    trained.remove(user_id)
+                updates.put((user_id, None if agent is None else agent.get_parameters(), True,
+                             train_seconds.pop(user_id, 0.0)))
+
+        for user_id in trained:
+            updates.put((user_id, agents[user_id].get_parameters(), False, train_seconds[user_id]))
+
+
+def new_agent(parameters, log_dir=None, observation_space=None, policy_class=AGENT_POLICY, settings=None):
+    # Updates of small policies are fastest on the CPU, and CPU tensors can be sent to the client threads as they are
+    settings = AGENT_KWARGS if settings is None else settings
+    agent = PPO(policy_class, SpacesEnv(observation_space), device='cpu', **{**settings, 'verbose': 0})
+    agent.set_parameters(parameters)
+    # Training statistics go to progress.csv in the log directory of the session
+    agent.set_logger(configure(log_dir, ['csv']) if log_dir is not None else Logger(None, []))
+    return agent
+
+
+def pack_rollout(steps, last_value, done):
+    """Stacks the (observation, action, reward, episode_start, value, log_prob) steps of a rollout into arrays.
+
+    Observations are the preprocessed ones of policy.obs_to_tensor, so they have the layout of the rollout buffer."""
+    observations, actions, rewards, episode_starts, values, log_probs = zip(*steps)
+    return {'observations': {key: np.stack([observation[key] for observation in observations])
+                             for key in observations[0]},
+            'actions': np.array(actions), 'rewards': np.array(rewards, dtype=np.float32),
+            'episode_starts': np.array(episode_starts, dtype=np.float32),
+            'values': np.array(values, dtype=np.float32), 'log_probs': np.array(log_probs, dtype=np.float32),
+            'last_value': last_value, 'done': done}
+
+
+def train(agent, rollout):
+    buffer = agent.rollout_buffer
+    buffer.reset()
+    for i in range(len(rollout['actions'])):
+        buffer.add({key: value[i:i + 1] for key, value in rollout['observations'].items()},
+                   rollout['actions'][i:i + 1], rollout['rewards'][i:i + 1], rollout['episode_starts'][i:i + 1],
+                   torch.as_tensor(rollout['values'][i:i + 1]), torch.as_tensor(rollout['log_probs'][i:i + 1]))
+    buffer.compute_returns_and_advantage(last_values=torch.as_tensor([rollout['last_value']]),
+                                         dones=np.array([rollout['done']]))
+    agent.num_timesteps += len(rollout['actions'])
+    agent.train()
+    agent.logger.dump(step=agent.num_timesteps)
+
+
+_learner = None
+_learner_lock = threading.Lock()
+
+
+def get_learner():
+    """Returns the process-wide learner, starting it on first use."""
+    global _learner
+    with _learner_lock:
+        if _learner is None:
+            _learner = Learner()
+        return _learner
@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import collections
+import random
+import re
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+IMAGE_FPS = 10  # Frames per second sent by static/js/script.js
+SONG_DURATION_SECONDS = 20
+JPEG_QUALITY = 92
+PHASES = 32  # Pre-encoded frames per pulse period
+METRICS_INTERVAL_SECONDS = 2
+HEART_BPM_PATTERN = re.compile(r'^music_heart_bpm\{user_id="(\d+)"\} (\S+)$', re.MULTILINE)
+FRAMES_PATTERN = re.compile(r'^music_frames_ingested_total(?:\{[^}]*\})? (\S+)$', re.MULTILINE)
+# Like static/js/script.js, otherwise the inner content routes redirect to the home page
+XHR_HEADERS = {'X-Requested-With': 'XMLHttpRequest'}
+
+
+def pulse_frames(amplitude, phases=PHASES, seed=0):
+    """JPEG frames (as the browser sends them) of one pulse period, brightness varying as a sine over the phases."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:480, 0:640]
+    face = np.exp(-(((x - 320) / 160) ** 2 + ((y - 240) / 160) ** 2))[..., None]
+    background = 90 + 100 * face * np.array([0.8, 0.9, 1.0]) + rng.normal(0, 2, (480, 640, 3))
+    frames = []
+    for phase in range(phases):
+        frame = np.clip(background + amplitude * np.sin(2 * np.pi * phase / phases) * face, 0, 255)
+        frames.append(cv2.imencode('.jpg', frame.astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1]
+                      .tobytes())
+    return frames
+
+
+class Stats:
+    def __init__(self):
+        self.action_latencies = []  # Seconds between the end of a song and the next action
+        self.actions = 0
+        self.frames_sent = 0
+        self.frame_errors = 0
+        self.sessions_started = 0
+        self.sessions_finished = 0
+        self.request_errors = 0  # Answers of /session, /action and /stop other than 200 (or 204 for long polls)
+        self.heart_bpms = collections.defaultdict(list)  # Estimates seen in /metrics per user id
+        self.true_bpms = dict()
+        self.frames_ingested = []  # (time, server frame counter)
+
+
+class Participant:
+    """Acts out static/js/script.js: gets a session, listens for actions, sends webcam frames and stops."""
+
+    def __init__(self, http, base_url, stats, frames, pulse_bpm, songs, playback_seconds, transport):
+        self.http = http
+        self.base_url = base_url
+        self.stats = stats
+        self.frames = frames
+        self.pulse_bpm = pulse_bpm
+        self.songs = songs
+        self.playback_seconds = playback_seconds
+        self.transport = transport
+        self.user_id = None
+        self.songs_played = 0
+        self.finished = asyncio.Event()
+
+    async def run(self):
+        async with self.http.get(f'{self.base_url}/session', headers=XHR_HEADERS, allow_redirects=False) as response:
+            self.check(response, '/session')
+            self.user_id = int(await response.text())
+        self.stats.sessions_started += 1
+        self.stats.true_bpms[self.user_id] = self.pulse_bpm
+        sender = asyncio.create_task(self.send_frames())
+        try:
+            if self.transport == 'sse':
+                await self.listen_stream()
+            else:
+                await self.poll_actions()
+        finally:
+            self.finished.set()
+            await sender
+        self.stats.sessions_finished += 1
+
+    async def send_frames(self):
+        started = time.time()
+        frame_number = 0
+        while not self.finished.is_set():
+            captured = time.time()
+            phase = int((captured - started) * self.pulse_bpm / 60 * len(self.frames)) % len(self.frames)
+            try:
+                async with self.http.post(f'{self.base_url}/image', params={'user_id': self.user_id, 't': captured},
+                                          data=self.frames[phase], headers={'content-type': 'image/jpeg'},
+                                          allow_redirects=False) as response:
+                    await response.read()
+                    if response.status == 200:
+                        self.stats.frames_sent += 1
+                    else:
+                        self.stats.frame_errors += 1
+            except aiohttp.ClientError:
+                self.stats.frame_errors += 1
+            # Like setInterval, frames are due at a fixed rate regardless of how long a request took
+            frame_number += 1
+            await asyncio.sleep(max(0.0, started + frame_number / IMAGE_FPS - time.time()))
+
+    async def handle_action(self, action, previous_action_time):
+        # Returns the arrival time of the action; the previous one ended playing playback_seconds after it arrived
+        now = time.monotonic()
+        self.stats.actions += 1
+        if previous_action_time is not None:
+            self.stats.action_latencies.append(now - previous_action_time - self.playback_seconds)
+        if action != 'start':
+            self.songs_played += 1
+            if self.songs_played == self.songs:
+                # Keep sending frames and listening until the server ends the experiment
+                await self.stop()
+        return now
+
+    async def listen_stream(self):
+        previous_action_time = None
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+        async with self.http.get(f'{self.base_url}/action/stream', params={'user_id': self.user_id},
+                                 headers=XHR_HEADERS, allow_redirects=False, timeout=timeout) as response:
+            self.check(response, '/action/stream')
+            async for line in response.content:
+                line = line.decode().strip()
+                if not line.startswith('data: '):
+                    continue  # Keepalive comments and event separators
+                action = line[len('data: '):]
+                if action == 'end':
+                    return
+                previous_action_time = await self.handle_action(action, previous_action_time)
+
+    async def poll_actions(self):
+        previous_action_time = None
+        while True:
+            async with self.http.get(f'{self.base_url}/action', params={'user_id': self.user_id, 'timeout': 10},
+                                     headers=XHR_HEADERS, allow_redirects=False) as response:
+                if response.status == 204:
+                    continue
+                self.check(response, '/action')
+                action = await response.text()
+            if action == 'end':
+                return
+            previous_action_time = await self.handle_action(action, previous_action_time)
+
+    async def stop(self):
+        async with self.http.get(f'{self.base_url}/stop', params={'user_id': self.user_id}, headers=XHR_HEADERS,
+                                 allow_redirects=False) as response:
+            self.check(response, '/stop')
+            await response.read()
+
+    def check(self, response, route):
+        # Without the session or the action stream the participant can't go on, so it fails
+        if response.status != 200:
+            self.stats.request_errors += 1
+            raise RuntimeError(f'{route} answered {response.status} for session {self.user_id}')
+
+
+async def scrape_metrics(http, base_url, stats, done):
+    # Heart rate estimates of the sessions and the server's frame counter, from the Prometheus endpoint
+    while not done.is_set():
+        try:
+            async with http.get(f'{base_url}/metrics') as response:
+                text = await response.text()
+        except aiohttp.ClientError:
+            text = ''
+        for user_id, bpm in HEART_BPM_PATTERN.findall(text):
+            estimates = stats.heart_bpms[int(user_id)]
+            if not estimates or estimates[-1] != float(bpm):
+                estimates.append(float(bpm))
+        stats.frames_ingested.append((time.monotonic(), sum(float(value) for value in FRAMES_PATTERN.findall(text))))
+        try:
+            await asyncio.wait_for(done.wait(), timeout=METRICS_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def load_test(base_url, participants, songs, pulse_bpm, pulse_spread, amplitude, time_scale, ramp_seconds,
+                    transport, seed):
+    stats = Stats()
+    rng = random.Random(seed)
+    frames = pulse_frames(amplitude, seed=seed)
+    playback_seconds = SONG_DURATION_SECONDS / time_scale
+    connector = aiohttp.TCPConnector(limit=0)
+    started = time.monotonic()
+    async with aiohttp.ClientSession(connector=connector) as http:
+        done = asyncio.Event()
+        scraper = asyncio.create_task(scrape_metrics(http, base_url, stats, done))
+        tasks = []
+        for _ in range(participants):
+            participant = Participant(http, base_url, stats, frames, rng.uniform(pulse_bpm - pulse_spread,
+                                                                                 pulse_bpm + pulse_spread),
+                                      songs, playback_seconds, transport)
+            tasks.append(asyncio.create_task(participant.run()))
+            await asyncio.sleep(ramp_seconds / participants)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        done.set()
+        await scraper
+    for result in results:
+        if isinstance(result, Exception):
+            print(f'Participant failed: {result!r}')
+    return stats, time.monotonic() - started
+
+
+def report(stats, elapsed):
+    print(f'{stats.sessions_finished}/{stats.sessions_started} sessions finished in {elapsed:.1f} s')
+    print(f'Actions: {stats.actions}')
+    if stats.action_latencies:
+        latencies = sorted(stats.action_latencies)
+        p50 = statistics.median(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+        print(f'Action latency beyond song playback: p50 {p50:.3f} s, p99 {p99:.3f} s, max {latencies[-1]:.3f} s')
+    print(f'Frames sent: {stats.frames_sent} ({stats.frames_sent / elapsed:.1f}/s), errors: {stats.frame_errors}')
+    print(f'Failed requests to /session, /action and /stop: {stats.request_errors}')
+    if len(stats.frames_ingested) > 1:
+        (first_time, first_count), (last_time, last_count) = stats.frames_ingested[0], stats.frames_ingested[-1]
+        print(f'Frames ingested by the server: {(last_count - first_count) / max(last_time - first_time, 1e-9):.1f}/s')
+    errors = [abs(estimate - stats.true_bpms[user_id])
+              for user_id, estimates in stats.heart_bpms.items() if user_id in stats.true_bpms
+              for estimate in estimates]
+    if errors:
+        print(f'Heart rate error: mean {statistics.mean(errors):.1f} BPM, median {statistics.median(errors):.1f} BPM '
+              f'over {len(errors)} estimates')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent participants of the experiment.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--participants', type=int, default=10)
+    parser.add_argument('--songs', type=int, default=5, help='songs per participant before it stops')
+    parser.add_argument('--pulse-bpm', type=float, default=72, help='mean heart rate of the synthetic pulse')
+    parser.add_argument('--pulse-spread', type=float, default=15, help='participants get pulse-bpm +- this')
+    parser.add_argument('--amplitude', type=float, default=4, help='brightness change of the pulse (0-255 scale)')
+    parser.add_argument('--time-scale', type=float, default=1,
+                        help='must match the TIME_SCALE environment variable of the server')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds over which the participants start')
+    parser.add_argument('--transport', choices=['sse', 'poll'], default='sse',
+                        help='action stream (like the browser) or long-polling /action')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if aiohttp is None:
+        parser.error('the load test needs aiohttp (pip install aiohttp)')
+
+    stats, elapsed = asyncio.run(load_test(args.url, args.participants, args.songs, args.pulse_bpm,
+                                           args.pulse_spread, args.amplitude, args.time_scale, args.ramp,
+                                           args.transport, args.seed))
+    report(stats, elapsed)
@@ -0,0 +1,153 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+PREFIX = 'music_'
+SPAN_HISTORY = 10000  # Finished spans kept for the structured log, older ones are dropped
+LOG_INTERVAL_SECONDS = 60
+LOG_FILE = 'static/logs/metrics.jsonl'
+
+
+class Metrics:
+    """Counters, gauges and timed spans of the server, labelled (mostly by user_id).
+
+    Spans are aggregated into a count and a total duration per name and labels, and kept individually with their
+    start time for the structured log. Gauge functions are evaluated when the metrics are read, e.g. for queue
+    depths. prometheus() gives the text exposition format; log_forever() appends a JSON line per interval."""
+
+    def __init__(self, span_history=SPAN_HISTORY):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = dict()
+        self.gauge_functions = dict()
+        self.span_totals = collections.defaultdict(lambda: [0, 0.0])
+        self.spans = collections.deque(maxlen=span_history)
+        self.logger = None
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, series_labels(labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name, series_labels(labels)] = value
+
+    def register_gauge(self, name, function):
+        """Registers a function returning (labels, value) pairs, called whenever the metrics are read."""
+        with self.lock:
+            self.gauge_functions[name] = function
+
+    def forget(self, **labels):
+        # Drops the counters, gauges and span totals with these labels, e.g. of a session that ended
+        selected = set(series_labels(labels))
+        with self.lock:
+            for series in (self.counters, self.gauges, self.span_totals):
+                for key in [key for key in series if selected <= set(key[1])]:
+                    del series[key]
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - started, start=start, **labels)
+
+    def record_span(self, name, duration, start=None, **labels):
+        key = (name, series_labels(labels))
+        with self.lock:
+            totals = self.span_totals[key]
+            totals[0] += 1
+            totals[1] += duration
+            self.spans.append({'name': name, **labels, 'start': time.time() - duration if start is None else start,
+                               'seconds': duration})
+
+    def collect(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            span_totals = {key: tuple(totals) for key, totals in self.span_totals.items()}
+            gauge_functions = list(self.gauge_functions.items())
+        for name, function in gauge_functions:
+            try:
+                for labels, value in function():
+                    gauges[name, series_labels(labels)] = value
+            except Exception as error:
+                print(f'Could not read gauge {name}: {error}')
+        return counters, gauges, span_totals
+
+    def prometheus(self):
+        counters, gauges, span_totals = self.collect()
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                lines.extend(f'{PREFIX}{name}{format_labels(labels)} {value}'
+                             for (series_name, labels), value in sorted(series.items(), key=str)
+                             if series_name == name)
+        for name in sorted({name for name, _ in span_totals}):
+            lines.append(f'# TYPE {PREFIX}{name}_seconds summary')
+            for (span_name, labels), (count, total) in sorted(span_totals.items(), key=str):
+                if span_name == name:
+                    lines.append(f'{PREFIX}{name}_seconds_count{format_labels(labels)} {count}')
+                    lines.append(f'{PREFIX}{name}_seconds_sum{format_labels(labels)} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def start_logging(self, filename=LOG_FILE, interval=LOG_INTERVAL_SECONDS):
+        with self.lock:
+            if self.logger is not None:
+                return
+            self.logger = threading.Thread(target=self.log_forever, args=(filename, interval), daemon=True)
+        self.logger.start()
+
+    def log_forever(self, filename=LOG_FILE, interval=LOG_INTERVAL_SECONDS):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        previous_counters, previous_time = dict(), time.time()
+        while True:
+            time.sleep(interval)
+            counters, gauges, span_totals = self.collect()
+            now = time.time()
+            with self.lock:
+                spans = [span for span in self.spans if span['start'] + span['seconds'] > previous_time]
+            entry = {'time': now,
+                     'counters': [{'name': name, **dict(labels), 'value': value}
+                                  for (name, labels), value in counters.items()],
+                     'rates': [{'name': name, **dict(labels),
+                                'per_second': (value - previous_counters.get((name, labels), 0)) / (now - previous_time)}
+                               for (name, labels), value in counters.items()],
+                     'gauges': [{'name': name, **dict(labels), 'value': value}
+                                for (name, labels), value in gauges.items()],
+                     'span_totals': [{'name': name, **dict(labels), 'count': count, 'seconds': total}
+                                     for (name, labels), (count, total) in span_totals.items()],
+                     'spans': spans}
+            with open(filename, 'a') as file:
+                file.write(json.dumps(entry, default=str) + '\n')
+            previous_counters, previous_time = counters, now
+
+
+def series_labels(labels):
+    # Hashable, ordered labels of a series; labels that are None are left out
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Returns the process-wide metrics, creating them on first use."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
@@ -0,0 +1,154 @@
+import collections
+import copy
+import csv
+import inspect
+import os
+import sqlite3
+import threading
+
+from stable_baselines3 import PPO
+
+LOG_DIR = 'static/logs'
+INDEX_FILE = 'registry.sqlite'
+CACHE_SIZE = 8  # Deserialized agents kept in memory
+
+# Settings of new agents (loaded agents keep the settings they were saved with)
+AGENT_POLICY = "MultiInputPolicy"
+AGENT_KWARGS = {'verbose': 1, 'n_steps': 32, 'batch_size': 16}
+
+
+class ModelRegistry:
+    """Index of the saved agents, replacing the LIFO queue of zip paths.
+
+    The index (an SQLite file in the log directory) keeps the lineage, step count and mean episode reward of every
+    model, and remembers which log directories were scanned already. Checking out a model returns the most recently
+    added available one, like the queue did. The parameters of recently used models are cached in memory, so a new
+    session copies them into a fresh agent instead of loading the zip."""
+
+    def __init__(self, log_directory=LOG_DIR, cache_size=CACHE_SIZE, release_all=True):
+        self.log_directory = log_directory
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(log_directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(log_directory, INDEX_FILE), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS models (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'path TEXT UNIQUE, parent TEXT, steps INTEGER, mean_reward REAL, '
+                                    'available INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scanned (directory TEXT PRIMARY KEY)')
+            if release_all:
+                # Every saved model can be handed out again after a restart (but not while other workers run)
+                self.connection.execute('UPDATE models SET available = 1')
+        self.scan()
+
+    def scan(self):
+        """Indexes the models of log directories that haven't been scanned before."""
+        with self.lock:
+            scanned = {row[0] for row in self.connection.execute('SELECT directory FROM scanned')}
+        for directory in sorted(os.listdir(self.log_directory)):
+            path = os.path.join(self.log_directory, directory)
+            if directory in scanned or not os.path.isdir(path):
+                continue
+            steps, mean_reward = read_monitor(path)
+            for file in sorted(os.listdir(path)):
+                if ".zip" in file and "backup" not in file:
+                    self.add(f'{self.log_directory}/{directory}/{file}', steps=steps, mean_reward=mean_reward,
+                             replace=False)
+            with self.lock, self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO scanned VALUES (?)', (directory,))
+
+    def add(self, path, parent=None, steps=None, mean_reward=None, replace=True):
+        with self.lock, self.connection:
+            self.connection.execute(f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO models '
+                                    '(path, parent, steps, mean_reward, available) VALUES (?, ?, ?, ?, 1)',
+                                    (path, parent, steps, mean_reward))
+
+    def register(self, path, agent=None, parent=None):
+        """Adds a newly saved model. Passing the agent caches its parameters right away."""
+        steps, mean_reward = read_monitor(os.path.dirname(path))
+        if agent is not None:
+            steps = agent.num_timesteps
+            self.cache_parameters(path, agent)
+        self.add(path, parent=parent, steps=steps, mean_reward=mean_reward)
+        with self.lock, self.connection:
+            # The directory is complete, it doesn't have to be scanned on the next start
+            self.connection.execute('INSERT OR IGNORE INTO scanned VALUES (?)',
+                                    (os.path.basename(os.path.dirname(path)),))
+
+    def checkout(self):
+        """Returns the path of the most recently added available model and marks it as taken, or None."""
+        while True:
+            with self.lock, self.connection:
+                row = self.connection.execute('SELECT path FROM models WHERE available = 1 ORDER BY id DESC LIMIT 1'
+                                              ).fetchone()
+                if row is None:
+                    return None
+                # Only take it if no other training worker took it in the meantime
+                if self.connection.execute('UPDATE models SET available = 0 WHERE path = ? AND available = 1',
+                                           row).rowcount == 1:
+                    return row[0]
+
+    def load_agent(self, env, **kwargs):
+        """Checks out a model and returns it as an agent for the environment with its path, or (None, None).
+
+        Models that don't fit the environment (e.g. made for another observation mode) are skipped with a message."""
+        while True:
+            path = self.checkout()
+            if path is None:
+                return None, None
+            with self.lock:
+                cached = self.cache.get(path)
+                if cached is not None:
+                    self.cache.move_to_end(path)
+            try:
+                if cached is None:
+                    agent = PPO.load(path, env=env, **kwargs)
+                    self.cache_parameters(path, agent)
+                else:
+                    # Rebuilt with the saved settings (hyperparameters, tensorboard_log, ...), like PPO.load does
+                    parameters, steps, policy_class, settings = cached
+                    agent = PPO(policy_class, env, **{**settings, **kwargs})
+                    agent.set_parameters(parameters)  # Copies the cached tensors into the new agent
+                    agent.num_timesteps = steps
+            except (ValueError, KeyError, RuntimeError) as error:
+                print(f'Could not load {path}: {error}')
+                continue
+            return agent, path
+
+    def cache_parameters(self, path, agent):
+        parameters = copy.deepcopy(agent.get_parameters())
+        settings = agent_settings(agent)
+        with self.lock:
+            self.cache[path] = (parameters, agent.num_timesteps, agent.policy_class, settings)
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def models(self):
+        # (path, parent, steps, mean_reward, available) of every model, oldest first
+        with self.lock:
+            return self.connection.execute('SELECT path, parent, steps, mean_reward, available FROM models '
+                                           'ORDER BY id').fetchall()
+
+
+def agent_settings(agent):
+    """Returns the constructor arguments of PPO as the agent has them, e.g. the ones it was saved with."""
+    excluded = ('self', 'policy', 'env', 'device', '_init_setup_model')
+    return {name: copy.deepcopy(getattr(agent, name)) for name in inspect.signature(PPO.__init__).parameters
+            if name not in excluded and hasattr(agent, name)}
+
+
+def read_monitor(directory):
+    """Returns the number of steps and the mean episode reward in the Monitor log of a directory (None if unknown)."""
+    try:
+        with open(os.path.join(directory, 'monitor.csv'), newline='') as file:
+            file.readline()  # Metadata
+            episodes = list(csv.DictReader(file))
+    except OSError:
+        return None, None
+    if not episodes:
+        return 0, None
+    steps = sum(int(episode['l']) for episode in episodes)
+    mean_reward = sum(float(episode['r']) for episode in episodes) / len(episodes)
+    return steps, mean_reward
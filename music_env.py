@@ -1,18 +1,30 @@
+import collections
 import math
 import os
-import time
+import threading
 
 import gymnasium as gym
 import numpy as np
 
-from image_bpm import ImageBPM
+from bpm_service import get_bpm_service
+from experience_log import ExperienceRecorder, FILE_NAME_DTYPE
+from feature_cache import get_feature_cache
+from metrics import get_metrics
 from music_library import MusicLibrary
-from song_bpm_utils import compute_features, SONG_DIRECTORY
+from song_bpm_utils import SONG_DIRECTORY
+
+RENDER_HISTORY = 1000  # Steps kept for render(), older steps are dropped if render isn't called
+CHROMA_PADDING = 30
+# 'padded': 12 chroma rows between rows of zeros, shaped like an image for the default CNN
+# 'compact': the 12 x T chroma as it is (optionally averaged over time_pooling frames), for feature_extractors.py
+OBSERVATION_MODES = ('padded', 'compact')
+WAIT_MESSAGE_SECONDS = 10  # Waiting for images longer than this prints a message
 
 
 class MusicEnv(gym.Env):
     def __init__(self, image_queue, song_queue, max_song_bpm=300, max_heart_bpm=300, goal_heart_bpm=60, max_steps=1000,
-                 songs_per_episode=10, song_duration_seconds=20, sampling_rate=22050, hop_length=512, log_dir=None):
+                 songs_per_episode=10, song_duration_seconds=20, sampling_rate=22050, hop_length=512, log_dir=None,
+                 observation_mode='padded', time_pooling=1, user_id=None, playback_seconds=None):
         self.song_queue = song_queue
         self.actions = [self.pick_yes, self.pick_no]
         self.action_space = gym.spaces.Discrete(len(self.actions))
@@ -21,15 +33,12 @@ class MusicEnv(gym.Env):
         self.log_dir = log_dir
         self.sr = sampling_rate  # sampling rate songs
         self.hop_length = hop_length  # hop length of the time series for chroma
-        self.chroma_padding = 30
-        chroma_length = math.ceil((song_duration_seconds * self.sr) / self.hop_length)
-        self.observation_space = gym.spaces.Dict({'heart_bpm': gym.spaces.Discrete(300),
-                                                  'song_bpm': gym.spaces.Discrete(300),
-                                                  'chroma_stft': gym.spaces.Box(low=0, high=255,
-                                                                                shape=(12+self.chroma_padding,
-                                                                                       chroma_length, 1),
-                                                                                dtype=np.uint8)})
-        self.log = ''
+        self.chroma_padding = CHROMA_PADDING
+        self.observation_mode = observation_mode
+        self.time_pooling = time_pooling
+        self.observation_space = music_observation_space(song_duration_seconds, self.sr, self.hop_length,
+                                                         self.chroma_padding, observation_mode, time_pooling)
+        self.log = collections.deque(maxlen=RENDER_HISTORY)  # The text is only built when rendering
         self.max_steps = max_steps
         self.steps_left = max_steps
         self.songs_per_episode = songs_per_episode
@@ -37,16 +46,26 @@ class MusicEnv(gym.Env):
         self.state = None
         self.goal = goal_heart_bpm
         self.music_library = MusicLibrary()
+        self.feature_cache = get_feature_cache()
         self.next_song = None
         self.song_duration_seconds = song_duration_seconds
-        self.images_to_bpm = ImageBPM(image_queue=image_queue)
-        self.images_to_bpm.start()
-        self.experience_log = (f'#{{"max_song_bpm": {max_song_bpm}, "max_heart_bpm": {max_heart_bpm}'
-                               f', "goal_heart_bpm": {goal_heart_bpm}, "max_steps": {max_steps}'
-                               f', "songs_per_episode": {songs_per_episode}'
-                               f', "song_duration_seconds": {song_duration_seconds}, "sampling_rate": {sampling_rate}'
-                               f', "hop_length": {hop_length}}}\n')
-        self.experience_log += "heart_bpm,song_file,a,r,next_heart_bpm,next_song_file,terminated,truncated\n"
+        # Time a song plays before the heart rate is measured, shorter than the analysed duration in compressed time
+        self.playback_seconds = song_duration_seconds if playback_seconds is None else playback_seconds
+        self.user_id = user_id  # Label of the metrics
+        self.metrics = get_metrics()
+        self.images_to_bpm = get_bpm_service().register(image_queue, user_id)
+        self.halted = threading.Event()  # Set when the session is stopped, so waiting for images gives up
+        self.experience_recorder = None
+        if log_dir is not None:
+            self.experience_recorder = ExperienceRecorder(
+                os.path.join(log_dir, "experience_log.csv"),
+                columns=[('heart_bpm', np.int32), ('song_file', FILE_NAME_DTYPE), ('a', np.int32), ('r', object),
+                         ('next_heart_bpm', np.int32), ('next_song_file', FILE_NAME_DTYPE), ('terminated', bool),
+                         ('truncated', bool)],
+                metadata={"max_song_bpm": max_song_bpm, "max_heart_bpm": max_heart_bpm,
+                          "goal_heart_bpm": goal_heart_bpm, "max_steps": max_steps,
+                          "songs_per_episode": songs_per_episode, "song_duration_seconds": song_duration_seconds,
+                          "sampling_rate": sampling_rate, "hop_length": hop_length})
 
     def reset(self, seed=None, options=None):
         self.state = dict()
@@ -55,15 +74,16 @@ class MusicEnv(gym.Env):
         self.pick_yes()
         self.steps_left = self.max_steps
         self.songs_left = self.songs_per_episode
-        self.log = self.state_representation()
+        self.log.append((None, self.bpm_state(), None, False))
         return self.state.copy(), {}
 
     def step(self, action: int):
-        previous_state = self.state.copy()
-        self.experience_log += f'{self.state["heart_bpm"]},"{self.next_song}",{action},'
+        previous_state = self.bpm_state()
+        previous_song = self.next_song
 
         # Do selected action
-        self.actions[action]()
+        with self.metrics.span('env_step', user_id=self.user_id):
+            self.actions[action]()
 
         # Calculate reward
         reward = distance(previous_state["heart_bpm"], self.goal) - distance(self.state["heart_bpm"], self.goal)
@@ -72,7 +92,6 @@ class MusicEnv(gym.Env):
 
         if self.songs_left == 0:
             terminated = True
-            self.log += 'End of episode.\n'
             reward = 100 - distance(self.state["heart_bpm"], self.goal)
 
         self.steps_left -= 1
@@ -84,35 +103,55 @@ class MusicEnv(gym.Env):
         # if terminated or truncated:
         #     self.song_queue.put('end')
 
-        self.log += f'Reward: {reward}\n'
-        self.log += self.state_representation(previous_state=previous_state)
-        self.experience_log += f'{reward},{self.state["heart_bpm"]},"{self.next_song}",{terminated},{truncated}\n'
+        self.log.append((previous_state, self.bpm_state(), reward, terminated))
+        if self.experience_recorder is not None:
+            self.experience_recorder.record(previous_state["heart_bpm"], previous_song, action, reward,
+                                            self.state["heart_bpm"], self.next_song, terminated, truncated)
+            if terminated or truncated:
+                self.experience_recorder.flush()
         return self.state.copy(), reward, terminated, truncated, {}
 
+    def halt(self):
+        self.halted.set()
+        # Wakes pick_yes if it is waiting for the heart rate
+        self.images_to_bpm.cancel()
+
     def close(self):
         self.song_queue.put('end')
+        get_bpm_service().release(self.images_to_bpm)
         self.save_experience_log()
 
     def render(self, mode=None):
-        print(self.log)
-        self.log = ''
+        text = ''
+        for previous_state, state, reward, terminated in self.log:
+            if previous_state is not None:
+                if terminated:
+                    text += 'End of episode.\n'
+                text += f'Reward: {reward}\n'
+            text += self.state_representation(previous_state=previous_state, state=state)
+        print(text)
+        self.log.clear()
 
     def pick_yes(self):
         self.songs_left -= 1
         # Only put the directory before the action if it is a file name
         self.song_queue.put(f'{SONG_DIRECTORY}/{self.next_song}' if "." in self.next_song else self.next_song)
-        # Sleep so images can come in
-        time.sleep(self.song_duration_seconds)
-
-        # Get new heart bpm
-        counter = 0
-        while self.images_to_bpm.getBPM() == 60.0:  # Buffer isn't full yet
-            time.sleep(0.1)
-            counter += 1
-            if counter % 100 == 0:
-                print("Waiting for more images.")
-        new_bpm = self.images_to_bpm.getBPM()
+        # Estimate the heart rate over the frames of this song only, once all of them came in
+        self.images_to_bpm.start_window()
+        estimate = None
+        with self.metrics.span('wait_for_heart_rate', user_id=self.user_id):
+            while estimate is None and not self.halted.is_set():
+                estimate = self.images_to_bpm.wait_for_window(self.playback_seconds, timeout=WAIT_MESSAGE_SECONDS)
+                if estimate is None and not self.halted.is_set():
+                    print("Waiting for more images.")
+        if estimate is None:
+            # Stopped (or reaped) while waiting: end the episode with the latest estimate
+            self.songs_left = 0
+            new_bpm = self.images_to_bpm.getBPM()
+        else:
+            new_bpm = estimate.bpm
         self.state["heart_bpm"] = int(new_bpm)
+        self.metrics.set_gauge('heart_bpm', new_bpm, user_id=self.user_id)
         self.set_next_song()
 
     def pick_no(self):
@@ -120,33 +159,68 @@ class MusicEnv(gym.Env):
 
     def set_next_song(self):
         self.next_song = self.music_library.get_random_song()
-        features = compute_features(self.next_song, duration_seconds=self.song_duration_seconds)
+        with self.metrics.span('song_features', user_id=self.user_id):
+            features = self.feature_cache.get(self.next_song, duration_seconds=self.song_duration_seconds,
+                                              sampling_rate=self.sr, hop_length=self.hop_length)
         self.state['song_bpm'] = int(features['bpm'])
-        chroma_stft = np.round(features['chroma_stft'] * 255).astype(np.uint8)
-        # zero padding at top and bottom
-        padding = int(self.chroma_padding / 2)
-        chroma_stft = np.concatenate((np.zeros((padding, chroma_stft.shape[1])), chroma_stft), axis=0)
-        chroma_stft = np.concatenate((chroma_stft, np.zeros((self.chroma_padding - padding, chroma_stft.shape[1]))),
-                                     axis=0)
-        self.state['chroma_stft'] = np.expand_dims(chroma_stft, axis=2).astype(np.uint8)
+        self.state['chroma_stft'] = chroma_observation(features['chroma_stft'], self.chroma_padding,
+                                                       self.observation_mode, self.time_pooling)
 
-    def state_representation(self, previous_state=None):
+    def bpm_state(self):
+        return {'song_bpm': self.state['song_bpm'], 'heart_bpm': self.state['heart_bpm']}
+
+    def state_representation(self, previous_state=None, state=None):
+        state = self.state if state is None else state
         rep_str = ''
         for observation in ['song_bpm', 'heart_bpm']:
-            rep_str += f'{observation}: {self.state[observation]} BPM '
+            rep_str += f'{observation}: {state[observation]} BPM '
             if previous_state is not None:
-                rep_str += '↑' if self.state[observation] > previous_state[observation] \
-                    else '↓' if self.state[observation] < previous_state[observation] \
+                rep_str += '↑' if state[observation] > previous_state[observation] \
+                    else '↓' if state[observation] < previous_state[observation] \
                     else '-'
             rep_str += '\n'
         return rep_str
 
     def save_experience_log(self):
-        if self.log_dir is not None:
-            filename = os.path.join(self.log_dir, "experience_log.csv")
-            with open(filename, 'w') as file:
-                file.write(self.experience_log)
+        # Writes the remaining experiences, the rest has been streamed to the file already
+        if self.experience_recorder is not None:
+            self.experience_recorder.close()
 
 
 def distance(x, y):
     return abs(x - y)
+
+
+def music_observation_space(song_duration_seconds=20, sampling_rate=22050, hop_length=512,
+                            chroma_padding=CHROMA_PADDING, observation_mode='padded', time_pooling=1):
+    chroma_length = math.ceil((song_duration_seconds * sampling_rate) / hop_length)
+    if observation_mode == 'padded':
+        chroma_shape = (12+chroma_padding, chroma_length, 1)
+    elif observation_mode == 'compact':
+        chroma_shape = (12, math.ceil(chroma_length / time_pooling))
+    else:
+        raise ValueError(f'Unknown observation mode {observation_mode}, expected one of {OBSERVATION_MODES}')
+    return gym.spaces.Dict({'heart_bpm': gym.spaces.Discrete(300),
+                            'song_bpm': gym.spaces.Discrete(300),
+                            'chroma_stft': gym.spaces.Box(low=0, high=255, shape=chroma_shape, dtype=np.uint8)})
+
+
+def chroma_observation(chroma_stft, chroma_padding=CHROMA_PADDING, observation_mode='padded', time_pooling=1):
+    """Turns the uint8 12 x T chroma of the feature cache into the observation, written directly into the result."""
+    frames = chroma_stft.shape[1]
+    if observation_mode == 'padded':
+        # zero padding at top and bottom
+        padding = int(chroma_padding / 2)
+        observation = np.zeros((12 + chroma_padding, frames, 1), dtype=np.uint8)
+        observation[padding:padding + 12, :, 0] = chroma_stft
+        return observation
+
+    observation = np.empty((12, -(-frames // time_pooling)), dtype=np.uint8)
+    if time_pooling == 1:
+        observation[:] = chroma_stft
+    else:
+        # Mean of every time_pooling frames, the last group may be shorter
+        starts = np.arange(0, frames, time_pooling)
+        sums = np.add.reduceat(chroma_stft, starts, axis=1, dtype=np.uint32)
+        np.floor_divide(sums, np.diff(starts, append=frames), out=observation, casting='unsafe')
+    return observation
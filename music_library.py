@@ -1,25 +1,92 @@
-import os
 import random
 
-from song_bpm_utils import SONG_DIRECTORY
+from song_catalog import get_catalog
+
+BPM_STRATUM_SIZE = 20  # Width of the BPM ranges used for stratified sampling
+
+
+class ShufflePool:
+    """Set of song indices with O(1) random draws and O(1) removals (removed items are swapped with the last one)."""
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.positions = {item: position for position, item in enumerate(self.items)}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def draw(self):
+        return self.items[random.randrange(len(self.items))]
+
+    def remove(self, item):
+        position = self.positions.pop(item)
+        last = self.items.pop()
+        if last != item:
+            self.items[position] = last
+            self.positions[last] = position
 
 
 class MusicLibrary:
-    def __init__(self, repeat_shuffle=False):
-        self.song_list = []
-        song_categories = os.listdir(SONG_DIRECTORY)
-        for category in song_categories:
-            self.song_list += [f'{category}/{song}' for song in os.listdir(f'{SONG_DIRECTORY}/{category}')]
+    def __init__(self, repeat_shuffle=False, song_bpms=None, song_list=None):
+        # Songs ('category/file' names) of the catalog, unless a song_list is given
+        if song_list is None:
+            catalog = get_catalog()
+            song_list = catalog.song_list()
+            if song_bpms is None:
+                song_bpms = catalog.bpm_by_song()
+        self.song_list = list(song_list)
+        self.song_categories = [song.split('/')[0] for song in self.song_list]
+        # BPM per song (dict of song file name to BPM) for stratified sampling, the catalog's BPMs by default
+        self.song_bpms = dict() if song_bpms is None else song_bpms
+        self.song_strata = [self.song_bpms.get(song, 0) // BPM_STRATUM_SIZE for song in self.song_list]
         self.repeat_shuffle = repeat_shuffle
-        self.picked_songs = set()
+        self.reset_pools()
+
+    def reset_pools(self):
+        # Songs that haven't been picked yet, as a whole, per category and per BPM range
+        self.pool = ShufflePool(range(len(self.song_list)))
+        self.category_pools = self.group_pools(self.song_categories)
+        self.bpm_pools = self.group_pools(self.song_strata)
 
-    def get_random_song(self):
-        if self.repeat_shuffle:
-            random_song = random.choice(self.song_list)
+    def get_random_song(self, category_weights=None, bpm_stratified=False):
+        """Picks a random song, without repeats until every song has been picked (unless repeat_shuffle is set).
+
+        category_weights maps categories to relative probabilities. With bpm_stratified, every BPM range is equally
+        likely, regardless of how many songs it has (songs without a known BPM form one range)."""
+        if category_weights is not None:
+            pool = self.choose_pool(self.category_pools, category_weights)
+        elif bpm_stratified:
+            pool = self.choose_pool(self.bpm_pools, {stratum: 1 for stratum in self.bpm_pools})
         else:
-            random_song = random.choice([song for song in self.song_list if song not in self.picked_songs])
-            self.picked_songs.add(random_song)
-            # Clear picked song list if all songs have been picked once
-            if len(self.picked_songs) == len(self.song_list):
-                self.picked_songs = set()
-        return random_song
+            pool = self.pool
+        index = pool.draw()
+
+        if not self.repeat_shuffle:
+            self.remove(index)
+            # Reset the pools if all songs have been picked once
+            if len(self.pool) == 0:
+                self.reset_pools()
+        return self.song_list[index]
+
+    def choose_pool(self, pools, weights):
+        # Only choose between groups that still have songs left, fall back on all songs if none of them do
+        groups = [group for group, pool in pools.items() if len(pool) > 0 and weights.get(group, 0) > 0]
+        if not groups:
+            return self.pool
+        group = random.choices(groups, weights=[weights[group] for group in groups])[0]
+        return pools[group]
+
+    def remove(self, index):
+        self.pool.remove(index)
+        self.category_pools[self.song_categories[index]].remove(index)
+        self.bpm_pools[self.song_strata[index]].remove(index)
+
+    @staticmethod
+    def group_pools(groups):
+        indices = dict()
+        for index, group in enumerate(groups):
+            indices.setdefault(group, []).append(index)
+        return {group: ShufflePool(group_indices) for group, group_indices in indices.items()}
@@ -0,0 +1,170 @@
+import argparse
+import datetime
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+from stable_baselines3 import PPO
+
+from feature_cache import get_feature_cache
+from music_env import CHROMA_PADDING, music_observation_space
+from precompute_features import fit_frames
+from song_catalog import get_catalog
+from utils import read_experience_logs
+
+LOG_DIR = 'static/logs'
+DATASET_FILE = 'static/cache/replay_dataset.npz'
+MAX_WEIGHT = 20  # Upper bound of the advantage weights, keeps a few lucky transitions from dominating
+
+
+def build_replay_dataset(log_directory=LOG_DIR, filename=DATASET_FILE, song_duration_seconds=20,
+                         sampling_rate=22050, hop_length=512, workers=None):
+    """Turns the experience logs into a compact replay dataset.
+
+    Transitions refer to songs by index; the BPM and chroma of every song are stored once, taken from the feature
+    cache. Transitions of songs that are no longer in the library (or of the simulator) are left out."""
+    logs = read_experience_logs(log_directory, workers=workers)
+    catalog = get_catalog()
+    known = np.array([song in catalog and next_song in catalog
+                      for song, next_song in zip(logs['song_file'], logs['next_song_file'])], dtype=bool)
+    songs = np.unique(np.concatenate((logs['song_file'][known], logs['next_song_file'][known])))
+
+    frames = math.ceil((song_duration_seconds * sampling_rate) / hop_length)
+    feature_cache = get_feature_cache()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        features = list(executor.map(lambda song: feature_cache.get(song, duration_seconds=song_duration_seconds,
+                                                                    sampling_rate=sampling_rate,
+                                                                    hop_length=hop_length), songs))
+
+    dataset = {'heart_bpm': logs['heart_bpm'][known],
+               'song_index': np.searchsorted(songs, logs['song_file'][known]).astype(np.int32),
+               'action': logs['a'][known],
+               'reward': logs['r'][known],
+               'next_heart_bpm': logs['next_heart_bpm'][known],
+               'next_song_index': np.searchsorted(songs, logs['next_song_file'][known]).astype(np.int32),
+               'terminated': logs['terminated'][known],
+               'truncated': logs['truncated'][known],
+               'episode': logs.episodes()[known],
+               'songs': songs,
+               'song_bpm': np.array([song_features['bpm'] for song_features in features], dtype=np.int16),
+               'chroma_stft': np.stack([fit_frames(song_features['chroma_stft'], frames)
+                                        for song_features in features]) if songs.size else
+               np.zeros((0, 12, frames), dtype=np.uint8)}
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    np.savez(filename, **dataset)
+    print(f'{known.sum()} of {len(known)} transitions, {len(songs)} songs in {filename}.')
+
+
+class ReplayEnv(gym.Env):
+    """Plays back the transitions of a replay dataset; actions are ignored. Gives the agent the spaces of MusicEnv."""
+
+    def __init__(self, dataset, song_duration_seconds=20, sampling_rate=22050, hop_length=512):
+        self.dataset = dataset
+        self.action_space = gym.spaces.Discrete(2)
+        self.observation_space = music_observation_space(song_duration_seconds, sampling_rate, hop_length)
+        self.position = 0
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.position = 0
+        return self.observation(self.dataset['heart_bpm'], self.dataset['song_index'], self.position), {}
+
+    def step(self, action):
+        position = self.position
+        self.position = (position + 1) % len(self.dataset['action'])
+        observation = self.observation(self.dataset['next_heart_bpm'], self.dataset['next_song_index'], position)
+        return (observation, float(self.dataset['reward'][position]), bool(self.dataset['terminated'][position]),
+                bool(self.dataset['truncated'][position]), {})
+
+    def observation(self, heart_bpm, song_index, position):
+        batch = observations(self.dataset, heart_bpm[position:position + 1], song_index[position:position + 1])
+        return {key: value[0] for key, value in batch.items()}
+
+
+def observations(dataset, heart_bpm, song_index):
+    # Same observations as MusicEnv, for a batch of transitions
+    chroma_stft = dataset['chroma_stft'][song_index]
+    padding = int(CHROMA_PADDING / 2)
+    padded = np.zeros((len(song_index), 12 + CHROMA_PADDING, chroma_stft.shape[2], 1), dtype=np.uint8)
+    padded[:, padding:padding + 12, :, 0] = chroma_stft
+    return {'heart_bpm': heart_bpm, 'song_bpm': dataset['song_bpm'][song_index], 'chroma_stft': padded}
+
+
+def discounted_returns(rewards, episodes, gamma):
+    returns = np.zeros(len(rewards))
+    next_return = 0.0
+    for i in reversed(range(len(rewards))):
+        if i == len(rewards) - 1 or episodes[i + 1] != episodes[i]:
+            next_return = 0.0
+        next_return = rewards[i] + gamma * next_return
+        returns[i] = next_return
+    return returns
+
+
+def pretrain(dataset_file=DATASET_FILE, initial_model=None, epochs=10, batch_size=256, beta=1.0, threads=None,
+             log_directory=LOG_DIR):
+    """Pretrains an agent on the replay dataset with advantage-weighted behaviour cloning.
+
+    The policy imitates the logged actions, weighted by how much better than expected they turned out, and the value
+    function regresses on the discounted returns. The agent is saved in a new log directory, where the model
+    registry finds it when the server starts."""
+    torch.set_num_threads(threads or os.cpu_count())
+    dataset = dict(np.load(dataset_file))
+    env = ReplayEnv(dataset)
+    if initial_model is not None:
+        agent = PPO.load(initial_model, env=env)
+    else:
+        agent = PPO("MultiInputPolicy", env, verbose=1, n_steps=32, batch_size=16)
+    policy = agent.policy
+    policy.set_training_mode(True)
+
+    returns = discounted_returns(dataset['reward'], dataset['episode'], agent.gamma)
+    size = len(returns)
+    for epoch in range(epochs):
+        total_loss = 0.0
+        permutation = np.random.permutation(size)
+        for start in range(0, size, batch_size):
+            indices = permutation[start:start + batch_size]
+            obs, _ = policy.obs_to_tensor(observations(dataset, dataset['heart_bpm'][indices],
+                                                       dataset['song_index'][indices]))
+            actions = torch.as_tensor(dataset['action'][indices], device=policy.device).long()
+            batch_returns = torch.as_tensor(returns[indices], device=policy.device).float()
+
+            values, log_prob, _ = policy.evaluate_actions(obs, actions)
+            values = values.flatten()
+            advantages = batch_returns - values.detach()
+            advantages = (advantages - advantages.mean()) / (advantages.std(unbiased=False) + 1e-8)
+            weights = torch.clamp(torch.exp(advantages / beta), max=MAX_WEIGHT)
+            loss = -(weights * log_prob).mean() + agent.vf_coef * F.mse_loss(values, batch_returns)
+
+            policy.optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(policy.parameters(), agent.max_grad_norm)
+            policy.optimizer.step()
+            total_loss += loss.item() * len(indices)
+        print(f'Epoch {epoch + 1}/{epochs}: loss {total_loss / max(size, 1):.4f}')
+
+    log_dir = f'{log_directory}/log{datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}-pretrained/'
+    os.makedirs(log_dir, exist_ok=True)
+    agent.save(os.path.join(log_dir, "last_model"))
+    print(f'Saved the pretrained agent in {log_dir}.')
+    return agent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pretrain an agent on the recorded experience logs.')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the replay dataset from the logs')
+    parser.add_argument('--initial-model', default=None, help='agent zip to start from (default: a new agent)')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--beta', type=float, default=1.0, help='temperature of the advantage weights')
+    parser.add_argument('--workers', type=int, default=None, help='processes/threads for reading and training')
+    args = parser.parse_args()
+    if args.rebuild or not os.path.exists(DATASET_FILE):
+        build_replay_dataset(workers=args.workers)
+    pretrain(initial_model=args.initial_model, epochs=args.epochs, batch_size=args.batch_size, beta=args.beta,
+             threads=args.workers)
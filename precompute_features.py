@@ -0,0 +1,113 @@
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from feature_cache import FeatureCache
+from song_bpm_utils import compute_extended_features
+from song_catalog import get_catalog
+
+FEATURE_FILE = 'static/cache/library_features.npz'
+SAMPLING_RATE = 22050
+HOP_LENGTH = 512
+
+# Per-frame features, stored as (songs, [rows,] frames) arrays padded/truncated to a common number of frames
+FRAME_FEATURES = {'chroma_stft': np.uint8, 'zero_crossing_rate': np.float32, 'spectral_centroid': np.float32,
+                  'spectral_bandwidth': np.float32, 'mfcc': np.float32}
+
+
+def analyze_song(song_file_name, duration_seconds):
+    start = time.perf_counter()
+    features = compute_extended_features(song_file_name, duration_seconds=duration_seconds)
+    features['chroma_stft'] = np.round(features['chroma_stft'] * 255).astype(np.uint8)
+    return song_file_name, features, time.perf_counter() - start
+
+
+def fit_frames(matrix, frames):
+    # Pad with zeros or truncate the last (time) axis to the given number of frames
+    fitted = np.zeros(matrix.shape[:-1] + (frames,), dtype=matrix.dtype)
+    length = min(frames, matrix.shape[-1])
+    fitted[..., :length] = matrix[..., :length]
+    return fitted
+
+
+def load_feature_file(filename, duration_seconds):
+    """Returns the existing columns as a dict of rows per song, or an empty dict if nothing can be reused."""
+    try:
+        with np.load(filename) as data:
+            if float(data['duration_seconds']) != duration_seconds:
+                return {}
+            columns = {name: data[name] for name in data.files}
+    except (OSError, KeyError, ValueError):
+        return {}
+    rows = dict()
+    for i, song in enumerate(columns['song']):
+        rows[str(song)] = {name: column[i] for name, column in columns.items()
+                           if name not in ('song', 'duration_seconds')}
+    return rows
+
+
+def save_feature_file(filename, rows, duration_seconds):
+    songs = sorted(rows)
+    columns = {'song': np.array(songs), 'duration_seconds': np.float32(duration_seconds)}
+    for name in rows[songs[0]] if songs else []:
+        columns[name] = np.stack([rows[song][name] for song in songs])
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as file:
+        np.savez(file, **columns)
+    os.replace(tmp_filename, filename)
+
+
+def precompute_features(filename=FEATURE_FILE, duration_seconds=20, workers=None, warm_cache=False):
+    frames = math.ceil((duration_seconds * SAMPLING_RATE) / HOP_LENGTH)
+    existing = load_feature_file(filename, duration_seconds)
+    feature_cache = FeatureCache() if warm_cache else None
+
+    # Only analyze songs that are new or have changed since the last run
+    catalog = get_catalog()
+    rows = dict()
+    todo = []
+    for song in catalog.song_list():
+        mtime = catalog.mtime(song)
+        if song in existing and int(existing[song]['mtime_ns']) == mtime:
+            rows[song] = existing[song]
+        else:
+            todo.append((song, mtime))
+    print(f'{len(rows)} songs unchanged, {len(todo)} songs to analyze.')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_song, song, duration_seconds): mtime for song, mtime in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                song, features, seconds = future.result()
+            except Exception as error:
+                print(f'[{done}/{len(todo)}] failed: {error}')
+                continue
+            row = {'mtime_ns': np.int64(futures[future]), 'bpm': np.int16(features['bpm']),
+                   'tempo': np.float32(features['tempo'])}
+            for name, dtype in FRAME_FEATURES.items():
+                row[name] = fit_frames(features[name].astype(dtype), frames)
+            rows[song] = row
+            if feature_cache is not None:
+                feature_cache.save(feature_cache.key(song, duration_seconds, SAMPLING_RATE, HOP_LENGTH),
+                                   {'bpm': int(features['bpm']), 'chroma_stft': features['chroma_stft']})
+            print(f'[{done}/{len(todo)}] {song} ({seconds:.2f}s)')
+
+    save_feature_file(filename, rows, duration_seconds)
+    print(f'Analyzed {len(todo)} songs in {time.perf_counter() - start:.1f}s, {len(rows)} songs in {filename}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute song features for the whole library.')
+    parser.add_argument('--output', default=FEATURE_FILE, help='columnar feature file to create or update')
+    parser.add_argument('--duration', type=int, default=20, help='seconds of each song to analyze')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--warm-cache', action='store_true', help='also fill the feature cache used by MusicEnv')
+    args = parser.parse_args()
+    precompute_features(filename=args.output, duration_seconds=args.duration, workers=args.workers,
+                        warm_cache=args.warm_cache)
@@ -0,0 +1,347 @@
+import itertools
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+
+IMAGE_QUEUE_SIZE = 150  # Frames waiting for the estimator, older frames are dropped when it falls behind
+SESSION_TTL_SECONDS = 3600  # Redis keys of sessions nobody touched for this long expire
+KEY_PREFIX = 'music'
+POLL_SECONDS = 0.01  # Queues that can't be waited on together are polled at this interval
+
+
+class NotifyingQueue(queue.Queue):
+    """queue.Queue that sets an event, shared by the queues of a backend, whenever an item is put."""
+
+    def __init__(self, maxsize=0, arrived=None):
+        super().__init__(maxsize)
+        self.arrived = arrived if arrived is not None else threading.Event()
+
+    def _put(self, item):
+        super()._put(item)
+        self.arrived.set()
+
+
+class InMemoryBackend:
+    """Session state of a single process: plain queue.Queue objects in a dict.
+
+    The web server and the client threads then have to run in the same process, which is the default setup."""
+
+    def __init__(self, image_queue_size=IMAGE_QUEUE_SIZE):
+        self.image_queue_size = image_queue_size
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.sessions = dict()
+        self.pending = queue.Queue()  # Submitted sessions, claimed by training workers
+        self.frames_arrived = threading.Event()  # Set by every put on an image queue, see wait_for_items
+
+    def create_session(self):
+        with self.lock:
+            user_id = next(self.ids)
+            self.sessions[user_id] = {'image_queue': NotifyingQueue(self.image_queue_size, self.frames_arrived),
+                                      'action_queue': queue.Queue(), 'last_seen': time.time(), 'stop': False,
+                                      'stream': 0}
+        return user_id
+
+    def submit(self, user_id):
+        self.pending.put(user_id)
+
+    def claim(self, timeout=None):
+        """Returns the id of the oldest submitted session, or None if there was none within timeout seconds."""
+        try:
+            return self.pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def image_queue(self, user_id):
+        with self.lock:
+            return self.sessions[user_id]['image_queue']
+
+    def action_queue(self, user_id):
+        with self.lock:
+            return self.sessions[user_id]['action_queue']
+
+    def touch(self, user_id):
+        # Raises a KeyError for unknown (or removed) sessions
+        with self.lock:
+            self.sessions[user_id]['last_seen'] = time.time()
+
+    def last_seen(self, user_id):
+        """Returns the time (time.time()) of the last request of the session, or None if it is gone."""
+        with self.lock:
+            session = self.sessions.get(user_id)
+            return None if session is None else session['last_seen']
+
+    def start_stream(self, user_id):
+        """Returns the token of a new action stream of the session; older streams of it should end."""
+        with self.lock:
+            self.sessions[user_id]['stream'] += 1
+            return self.sessions[user_id]['stream']
+
+    def stream_token(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            return None if session is None else session['stream']
+
+    def request_stop(self, user_id):
+        with self.lock:
+            self.sessions[user_id]['stop'] = True
+
+    def stop_requested(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            return session is not None and session['stop']
+
+    def remove_session(self, user_id):
+        with self.lock:
+            self.sessions.pop(user_id, None)
+
+
+class RedisQueue:
+    """The part of the queue.Queue interface the sessions use, on a Redis list of encoded items.
+
+    Items are encoded with encode (bytes or str) and decoded with decode, never unpickled, so whoever can write to Redis
+    can't run code in the processes that read it. With a maxsize the list is trimmed to the newest maxsize items on
+    every put, so puts never block or raise queue.Full: the oldest items are dropped, like utils.put_latest does on a
+    bounded queue.Queue."""
+
+    def __init__(self, redis, key, maxsize=0, encode=None, decode=None):
+        self.redis = redis
+        self.key = key
+        self.maxsize = maxsize
+        self.encode = encode or encode_json
+        self.decode = decode or decode_json
+
+    def put(self, item, block=True, timeout=None):
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(self.key, self.encode(item))
+        if self.maxsize > 0:
+            pipeline.ltrim(self.key, -self.maxsize, -1)
+        pipeline.expire(self.key, SESSION_TTL_SECONDS)
+        pipeline.execute()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_front(self, item):
+        pipeline = self.redis.pipeline()
+        pipeline.lpush(self.key, self.encode(item))
+        pipeline.expire(self.key, SESSION_TTL_SECONDS)
+        pipeline.execute()
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return self.get_nowait()
+        # A timeout of 0 blocks forever in Redis
+        item = self.redis.blpop([self.key], timeout=0 if timeout is None else max(timeout, 0.01))
+        if item is None:
+            raise queue.Empty
+        return self.decoded(item[1])
+
+    def get_nowait(self):
+        item = self.redis.lpop(self.key)
+        if item is None:
+            raise queue.Empty
+        return self.decoded(item)
+
+    def decoded(self, data):
+        # Malformed items are dropped, as if the queue had been empty
+        try:
+            return self.decode(data)
+        except (ValueError, KeyError, TypeError) as error:
+            print(f'Dropped a malformed item of {self.key}: {error}')
+            raise queue.Empty
+
+    @staticmethod
+    def get_many(queues, count):
+        """Takes up to count items from each queue (all on one connection) in one round trip."""
+        pipeline = queues[0].redis.pipeline()
+        for redis_queue in queues:
+            pipeline.lrange(redis_queue.key, 0, count - 1)
+            pipeline.ltrim(redis_queue.key, count, -1)
+        batches = []
+        for redis_queue, items in zip(queues, pipeline.execute()[::2]):
+            batch = []
+            for data in items:
+                try:
+                    batch.append(redis_queue.decoded(data))
+                except queue.Empty:
+                    pass
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def get_any(queues, timeout):
+        """Takes the first item put on any of the queues (all on one connection) within timeout seconds.
+
+        Returns (index of the queue, item), or None."""
+        keys = [redis_queue.key for redis_queue in queues]
+        item = queues[0].redis.blpop(keys, timeout=max(timeout, 0.01))
+        if item is None:
+            return None
+        key = item[0].decode('utf-8') if isinstance(item[0], bytes) else item[0]
+        index = keys.index(key)
+        try:
+            return index, queues[index].decoded(item[1])
+        except queue.Empty:
+            return None
+
+    def qsize(self):
+        return self.redis.llen(self.key)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class RedisBackend:
+    """Session state in Redis, shared by every web server process and training worker that connects to it.
+
+    Frames and actions go through Redis lists, session ids come from a counter, and submitted sessions wait in a list
+    that the training workers pop from. Anything speaking the Redis protocol works, e.g. a local redis-server, KeyDB or
+    a fakeredis client passed in as client."""
+
+    def __init__(self, url=None, client=None, image_queue_size=IMAGE_QUEUE_SIZE, prefix=KEY_PREFIX):
+        if client is None:
+            try:
+                import redis
+            except ImportError as error:
+                raise RuntimeError('The Redis session backend needs the redis package (pip install redis)') from error
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.image_queue_size = image_queue_size
+        self.prefix = prefix
+
+    def key(self, user_id, name):
+        return f'{self.prefix}:session:{user_id}:{name}'
+
+    def create_session(self):
+        # Ids start at 0, like the in-memory ones
+        user_id = self.redis.incr(f'{self.prefix}:next_id') - 1
+        self.redis.set(self.key(user_id, 'last_seen'), time.time(), ex=SESSION_TTL_SECONDS)
+        return user_id
+
+    def submit(self, user_id):
+        self.redis.rpush(f'{self.prefix}:pending', user_id)
+
+    def claim(self, timeout=None):
+        """Returns the id of the oldest submitted session, or None if there was none within timeout seconds."""
+        item = self.redis.blpop([f'{self.prefix}:pending'], timeout=0 if timeout is None else max(timeout, 0.01))
+        return None if item is None else int(item[1])
+
+    def image_queue(self, user_id):
+        return RedisQueue(self.redis, self.key(user_id, 'images'), self.image_queue_size, encode_frame, decode_frame)
+
+    def action_queue(self, user_id):
+        return RedisQueue(self.redis, self.key(user_id, 'actions'))
+
+    def touch(self, user_id):
+        # Raises a KeyError for unknown (or removed) sessions
+        if not self.redis.set(self.key(user_id, 'last_seen'), time.time(), ex=SESSION_TTL_SECONDS, xx=True):
+            raise KeyError(user_id)
+
+    def last_seen(self, user_id):
+        """Returns the time (time.time()) of the last request of the session, or None if it is gone."""
+        value = self.redis.get(self.key(user_id, 'last_seen'))
+        return None if value is None else float(value)
+
+    def start_stream(self, user_id):
+        """Returns the token of a new action stream of the session; older streams of it should end."""
+        if not self.redis.exists(self.key(user_id, 'last_seen')):
+            raise KeyError(user_id)
+        pipeline = self.redis.pipeline()
+        pipeline.incr(self.key(user_id, 'stream'))
+        pipeline.expire(self.key(user_id, 'stream'), SESSION_TTL_SECONDS)
+        return pipeline.execute()[0]
+
+    def stream_token(self, user_id):
+        value = self.redis.get(self.key(user_id, 'stream'))
+        return None if value is None else int(value)
+
+    def request_stop(self, user_id):
+        if not self.redis.exists(self.key(user_id, 'last_seen')):
+            raise KeyError(user_id)
+        self.redis.set(self.key(user_id, 'stop'), 1, ex=SESSION_TTL_SECONDS)
+
+    def stop_requested(self, user_id):
+        return bool(self.redis.exists(self.key(user_id, 'stop')))
+
+    def remove_session(self, user_id):
+        self.redis.delete(*(self.key(user_id, name) for name in ('last_seen', 'stop', 'stream', 'images',
+                                                                    'actions')))
+
+
+def get_many(queues, count):
+    """Takes up to count items from each queue, without blocking. Returns a list of items per queue.
+
+    Redis queues are drained in one round trip instead of one per item."""
+    if queues and all_redis(queues):
+        return RedisQueue.get_many(queues, count)
+    batches = []
+    for fifo_queue in queues:
+        batch = []
+        while len(batch) < count:
+            try:
+                batch.append(fifo_queue.get_nowait())
+            except queue.Empty:
+                break
+        batches.append(batch)
+    return batches
+
+
+def wait_for_items(queues, timeout):
+    """Waits up to timeout seconds for an item on any of the queues.
+
+    Redis queues block in one BLPOP, which takes the item: it is returned as (index of the queue, item). The queues of
+    an InMemoryBackend wait on their shared event and return None, the items stay in the queues. Other queues are
+    polled."""
+    if queues and all_redis(queues):
+        return RedisQueue.get_any(queues, timeout)
+    events = {getattr(fifo_queue, 'arrived', None) for fifo_queue in queues}
+    if len(events) == 1 and None not in events:
+        arrived = events.pop()
+        arrived.wait(timeout)
+        # Items put from here on set it again; the ones put before are in the queues already
+        arrived.clear()
+    else:
+        time.sleep(min(timeout, POLL_SECONDS))
+    return None
+
+
+def all_redis(queues):
+    return all(isinstance(fifo_queue, RedisQueue) and fifo_queue.redis is queues[0].redis for fifo_queue in queues)
+
+
+def encode_json(item):
+    return json.dumps(item)
+
+
+def decode_json(data):
+    return json.loads(data)
+
+
+def encode_frame(item):
+    # (frame, captured, received) of the image queue: a JSON header line with the shape and dtype, then the pixels
+    frame, captured, received = item
+    header = {'shape': frame.shape, 'dtype': frame.dtype.str, 'captured': captured, 'received': received}
+    return json.dumps(header).encode('utf-8') + b'\n' + np.ascontiguousarray(frame).tobytes()
+
+
+def decode_frame(data):
+    header, pixels = data.split(b'\n', 1)
+    header = json.loads(header)
+    dtype = np.dtype(header['dtype'])
+    if dtype.kind not in 'uif':
+        raise ValueError(f'Frames must be numeric, not {dtype}')
+    frame = np.frombuffer(pixels, dtype=dtype).reshape(header['shape'])
+    return frame, header['captured'], header['received']
+
+
+def make_backend(url=None):
+    """Returns the session backend for a URL: None or 'memory' for the in-memory one, redis://... for Redis."""
+    if url is None or url == 'memory':
+        return InMemoryBackend()
+    if url.split('://')[0] in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    raise ValueError(f'Unknown session backend {url}')
@@ -0,0 +1,165 @@
+import collections
+import threading
+import time
+
+from client_thread import ClientThread
+from session_backend import InMemoryBackend
+
+MAX_SESSIONS = 8  # Sessions training at the same time, the others wait in the admission queue
+IDLE_TIMEOUT_SECONDS = 120  # Sessions without any request for this long are reaped
+REAP_INTERVAL_SECONDS = 5
+CLAIM_TIMEOUT_SECONDS = 1  # How long a training worker waits for a submitted session before checking its slots again
+
+# The queues of a session, as the routes of the web server use them
+SessionQueues = collections.namedtuple('SessionQueues', ['user_id', 'image_queue', 'action_queue'])
+
+
+class Session:
+    def __init__(self, user_id, model_registry, backend):
+        self.user_id = user_id
+        self.action_queue = backend.action_queue(user_id)
+        self.image_queue = backend.image_queue(user_id)
+        self.client = ClientThread(user_id=user_id, action_queue=self.action_queue, image_queue=self.image_queue,
+                                   model_registry=model_registry)
+
+    def is_running(self):
+        return self.client.is_alive()
+
+
+class SessionManager:
+    """Keeps track of the sessions of the experiment.
+
+    The state the web server needs (queues, time of the last request, stop requests) lives in the session backend.
+    With train_locally, this process trains the sessions it creates: at most max_sessions clients train at the same
+    time, later sessions wait in an admission queue until a slot frees up. Otherwise new sessions are submitted to
+    the backend, and training workers (training_worker.py) claim them while they have free slots. Sessions that
+    haven't made a request for idle_timeout seconds are stopped and forgotten."""
+
+    def __init__(self, model_registry=None, max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT_SECONDS,
+                 backend=None, train_locally=True):
+        self.model_registry = model_registry
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.backend = backend if backend is not None else InMemoryBackend()
+        self.train_locally = train_locally
+        self.lock = threading.Lock()
+        self.sessions = dict()  # Sessions trained by this process
+        self.waiting = collections.deque()
+        self.reaped = []  # Clients that were reaped but are still wrapping up, they keep their slot until they exit
+        self.reaper = None
+        if train_locally:
+            # Without local sessions there is nothing to reap, the training workers reap the sessions they claimed
+            self.reaper = threading.Thread(target=self.reap_forever, daemon=True)
+            self.reaper.start()
+
+    def create(self):
+        user_id = self.backend.create_session()
+        if self.train_locally:
+            self.start(user_id)
+        else:
+            self.backend.submit(user_id)
+        return user_id
+
+    def start(self, user_id):
+        with self.lock:
+            self.sessions[user_id] = Session(user_id, self.model_registry, self.backend)
+            self.waiting.append(user_id)
+            self.admit()
+
+    def get(self, user_id):
+        # Raises a KeyError for unknown (or reaped) sessions
+        self.backend.touch(user_id)
+        return SessionQueues(user_id, self.backend.image_queue(user_id), self.backend.action_queue(user_id))
+
+    def start_stream(self, user_id):
+        # Raises a KeyError for unknown (or reaped) sessions
+        return self.backend.start_stream(user_id)
+
+    def stream_token(self, user_id):
+        return self.backend.stream_token(user_id)
+
+    def touch(self, user_id):
+        try:
+            self.backend.touch(user_id)
+        except KeyError:
+            pass
+
+    def stop(self, user_id):
+        with self.lock:
+            if user_id in self.sessions:
+                self.stop_session(user_id)
+                return
+        # Trained by a worker (or not claimed yet), it stops the session when it sees the request
+        self.backend.request_stop(user_id)
+
+    def stop_session(self, user_id):
+        # Lock must be held
+        session = self.sessions[user_id]
+        if user_id in self.waiting:
+            # Never started, so there is no environment to end the experiment client-side
+            self.waiting.remove(user_id)
+            session.action_queue.put('end')
+        else:
+            session.client.halt_learning()
+
+    def admit(self):
+        # Start waiting sessions while there are free slots (lock must be held)
+        running = self.running()
+        while self.waiting and running < self.max_sessions:
+            self.sessions[self.waiting.popleft()].client.start()
+            running += 1
+
+    def running(self):
+        # Clients holding a slot (lock must be held)
+        self.reaped = [client for client in self.reaped if client.is_alive()]
+        return len(self.reaped) + sum(session.is_running() for session in self.sessions.values())
+
+    def claim_forever(self):
+        """Trains sessions submitted to the backend by the web servers, claiming one whenever a slot is free."""
+        while True:
+            with self.lock:
+                full = self.running() + len(self.waiting) >= self.max_sessions
+            if full:
+                time.sleep(CLAIM_TIMEOUT_SECONDS)
+                continue
+            user_id = self.backend.claim(timeout=CLAIM_TIMEOUT_SECONDS)
+            if user_id is None:
+                continue
+            if self.backend.stop_requested(user_id):
+                self.backend.action_queue(user_id).put('end')
+                continue
+            self.start(user_id)
+
+    def reap(self):
+        now = time.time()
+        with self.lock:
+            for user_id, session in list(self.sessions.items()):
+                if self.backend.stop_requested(user_id) and (user_id in self.waiting or session.client.is_alive()):
+                    self.stop_session(user_id)
+                last_seen = self.backend.last_seen(user_id)
+                if last_seen is not None and now - last_seen < self.idle_timeout:
+                    continue
+                # Stop training, the client saves the agent and exits; then drop the queues
+                if user_id in self.waiting:
+                    self.waiting.remove(user_id)
+                else:
+                    session.client.halt_learning()
+                    self.reaped.append(session.client)
+                del self.sessions[user_id]
+                self.backend.remove_session(user_id)
+            self.admit()
+
+    def reap_forever(self):
+        while True:
+            time.sleep(REAP_INTERVAL_SECONDS)
+            self.reap()
+
+    def queue_depths(self):
+        # (user_id, frames waiting for the estimator, actions waiting for the client) of every session
+        with self.lock:
+            return [(user_id, session.image_queue.qsize(), session.action_queue.qsize())
+                    for user_id, session in self.sessions.items()]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
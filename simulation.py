@@ -1,22 +1,27 @@
+import argparse
+import collections
 import os
 import random
+import time
 
 import gymnasium as gym
+import numpy as np
 from stable_baselines3 import PPO
-import os
-import random
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
 
-import gymnasium as gym
-from stable_baselines3 import PPO
+from experience_log import ExperienceRecorder, FILE_NAME_DTYPE
+
+RENDER_HISTORY = 1000  # Steps kept for render(), older steps are dropped if render isn't called
 
 
 class HeartRateSimulation:
-    def __init__(self):
+    def __init__(self, random_generator=random):
         self.min = 60
         self.max = 150
+        self.random = random_generator
 
     def get_new_rate(self, start, change):
-        change_var = change + (random.random() * 2) - 1  # variance of 1
+        change_var = change + (self.random.random() * 2) - 1  # variance of 1
         if change_var < 0:
             alpha = (start - self.min) / (self.max - self.min) * 0.8
         else:
@@ -26,7 +31,8 @@ class HeartRateSimulation:
 
 
 class MusicEnv(gym.Env):
-    def __init__(self, goal_heart_bpm=60, max_steps=1000, songs_per_episode=10, log_dir=None):
+    def __init__(self, goal_heart_bpm=60, max_steps=1000, songs_per_episode=10, log_dir=None, log_experience=True):
+        self.random = random.Random()
         self.song_options = {
             'rock': 20,
             'salsa': 15,
@@ -34,14 +40,16 @@ class MusicEnv(gym.Env):
             'meditation': -20,
             'techno': 30
         }
-        self.heart = HeartRateSimulation()
+        self.song_names = list(self.song_options.keys())
+        self.heart = HeartRateSimulation(random_generator=self.random)
         self.heart_rate = 80
         self.actions = [self.pick_yes, self.pick_no]
         self.action_space = gym.spaces.Discrete(len(self.actions))
         self.observation_space = gym.spaces.Dict({'heart_bpm': gym.spaces.Discrete(300),
                                                   'song_bpm': gym.spaces.Discrete(300)})
-        self.log = ''
+        self.log = collections.deque(maxlen=RENDER_HISTORY)  # The text is only built when rendering
         self.log_dir = log_dir
+        self.log_experience = log_experience  # Turn off to skip all logging, e.g. for fast training
         self.max_steps = max_steps
         self.steps_left = max_steps
         self.songs_per_episode = songs_per_episode
@@ -49,25 +57,34 @@ class MusicEnv(gym.Env):
         self.state = None
         self.goal = goal_heart_bpm
         self.next_song = None
-        self.experience_log = ("heart_bpm,song_file,song_bpm,a,r,next_heart_bpm,next_song_file,next_song_bpm"
-                               ",terminated,truncated\n")
+        self.experience_recorder = None
+        if log_dir is not None and log_experience:
+            self.experience_recorder = ExperienceRecorder(
+                os.path.join(log_dir, "experience_log.csv"),
+                columns=[('heart_bpm', np.int32), ('song_file', FILE_NAME_DTYPE), ('song_bpm', np.int32),
+                         ('a', np.int32), ('r', object), ('next_heart_bpm', np.int32),
+                         ('next_song_file', FILE_NAME_DTYPE), ('next_song_bpm', np.int32), ('terminated', bool),
+                         ('truncated', bool)])
 
     def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        if seed is not None:
+            self.random.seed(seed)
         self.state = dict()
         self.set_next_song()
         self.state["heart_bpm"] = int(self.heart_rate)
         self.steps_left = self.max_steps
         self.songs_left = self.songs_per_episode
-        self.log = self.state_representation()
+        if self.log_experience:
+            self.log.append((None, self.state.copy(), None, None, False))
         return self.state.copy(), {}
 
     def step(self, action: int):
         previous_state = self.state.copy()
-        self.experience_log += f'{self.state["heart_bpm"]},"{self.next_song}",{self.state["song_bpm"]},{action},'
+        previous_song = self.next_song
 
         # Do selected action
         self.actions[action]()
-        self.log += f'Action: {"yes" if action == 0 else "no"}\n'
 
         # Calculate reward
         reward = distance(previous_state["heart_bpm"], self.goal) - distance(self.state["heart_bpm"], self.goal)
@@ -83,22 +100,30 @@ class MusicEnv(gym.Env):
         if truncated:
             reward = -1000
 
-        self.log += f'Reward: {reward}\n\n'
-
-        if terminated:
-            self.log += 'End of episode.\n'
-
-        self.log += self.state_representation(previous_state=previous_state)
-        self.experience_log += (f'{reward},{self.state["heart_bpm"]},"{self.next_song}",{self.state["song_bpm"]}'
-                                f',{terminated},{truncated}\n')
+        if self.log_experience:
+            self.log.append((previous_state, self.state.copy(), action, reward, terminated))
+        if self.experience_recorder is not None:
+            self.experience_recorder.record(previous_state["heart_bpm"], previous_song, previous_state["song_bpm"],
+                                            action, reward, self.state["heart_bpm"], self.next_song,
+                                            self.state["song_bpm"], terminated, truncated)
+            if terminated or truncated:
+                self.experience_recorder.flush()
         return self.state.copy(), reward, terminated, truncated, {}
 
     def close(self):
         self.save_experience_log()
 
     def render(self, mode=None):
-        print(self.log, end='')
-        self.log = ''
+        text = ''
+        for previous_state, state, action, reward, terminated in self.log:
+            if previous_state is not None:
+                text += f'Action: {"yes" if action == 0 else "no"}\n'
+                text += f'Reward: {reward}\n\n'
+                if terminated:
+                    text += 'End of episode.\n'
+            text += self.state_representation(previous_state=previous_state, state=state)
+        print(text, end='')
+        self.log.clear()
 
     def pick_yes(self):
         self.songs_left -= 1
@@ -109,41 +134,41 @@ class MusicEnv(gym.Env):
         self.set_next_song()
 
     def set_next_song(self):
-        self.next_song = random.choice(list(self.song_options.keys()))
-        self.state["song_bpm"] = bpm_from_change(self.song_options[self.next_song])
+        self.next_song = self.random.choice(self.song_names)
+        self.state["song_bpm"] = bpm_from_change(self.song_options[self.next_song], random_generator=self.random)
 
     def set_new_heart_rate(self):
         self.heart_rate = self.heart.get_new_rate(self.heart_rate, self.song_options[self.next_song])
         self.state["heart_bpm"] = int(self.heart_rate)
 
-    def state_representation(self, previous_state=None):
+    def state_representation(self, previous_state=None, state=None):
+        state = self.state if state is None else state
         rep_str = ''
         # for observation in ['song_bpm']:
         for observation in ['song_bpm', 'heart_bpm']:
-            rep_str += f'{observation}: {self.state[observation]} BPM '
+            rep_str += f'{observation}: {state[observation]} BPM '
             if previous_state is not None:
-                rep_str += '↑' if self.state[observation] > previous_state[observation] \
-                    else '↓' if self.state[observation] < previous_state[observation] \
+                rep_str += '↑' if state[observation] > previous_state[observation] \
+                    else '↓' if state[observation] < previous_state[observation] \
                     else '-'
             rep_str += '\n'
         return rep_str
 
     def save_experience_log(self):
-        if self.log_dir is not None:
-            filename = os.path.join(self.log_dir, "experience_log.csv")
-            with open(filename, 'w') as file:
-                file.write(self.experience_log)
+        # Writes the remaining experiences, the rest has been streamed to the file already
+        if self.experience_recorder is not None:
+            self.experience_recorder.close()
 
 
 def distance(x, y):
     return abs(x - y)
 
 
-def bpm_from_change(change):
+def bpm_from_change(change, random_generator=random):
     change_min = -50
     change_max = 50
     bpm = (change - change_min) / (change_max - change_min) * 250 + 25
-    bpm += (random.random() * 50) - 25
+    bpm += (random_generator.random() * 50) - 25
     return int(bpm)
 
 
@@ -158,8 +183,41 @@ def ppo_test():
         env.close()
 
 
+def ppo_vectorized(n_envs=None, total_timesteps=100000, seed=None, subprocesses=True, log_dir=None):
+    """Trains one agent on n_envs copies of the simulated environment and reports the throughput."""
+    n_envs = n_envs or os.cpu_count() or 1
+    env_fns = [lambda: MusicEnv(log_experience=False) for _ in range(n_envs)]
+    env = SubprocVecEnv(env_fns) if subprocesses else DummyVecEnv(env_fns)
+    # The seed also seeds the environments (seed, seed + 1, ...) on their first reset
+    agent = PPO("MultiInputPolicy", env=env, n_steps=32, batch_size=16, seed=seed, tensorboard_log=log_dir)
+
+    start = time.perf_counter()
+    agent.learn(total_timesteps)
+    elapsed = time.perf_counter() - start
+    print(f'{n_envs} environments ({"subprocess" if subprocesses else "dummy"}): {agent.num_timesteps} steps '
+          f'in {elapsed:.1f}s, {agent.num_timesteps / elapsed:.0f} steps/s')
+
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+        agent.save(os.path.join(log_dir, "last_model"))
+    env.close()
+    return agent
+
+
 if __name__ == '__main__':
-    ppo_test()
+    parser = argparse.ArgumentParser(description='Train agents on the simulated heart rate environment.')
+    parser.add_argument('--envs', type=int, default=None,
+                        help='train one agent on this many parallel environments instead of running ppo_test')
+    parser.add_argument('--timesteps', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--dummy', action='store_true', help='step the environments in this process')
+    parser.add_argument('--log-dir', default=None)
+    args = parser.parse_args()
+    if args.envs is None:
+        ppo_test()
+    else:
+        ppo_vectorized(n_envs=args.envs, total_timesteps=args.timesteps, seed=args.seed,
+                       subprocesses=not args.dummy, log_dir=args.log_dir)
 
 
 
@@ -3,6 +3,7 @@ import os
 import librosa
 import librosa.display
 import librosa.feature
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
 
@@ -15,21 +16,34 @@ def compute_bpm_from_file(song_file_name):
     return int(tempo)
 
 
-def compute_features(song_file_name, duration_seconds):
-    y, sr = librosa.load(f'{SONG_DIRECTORY}/{song_file_name}', duration=duration_seconds, offset=0)
+def compute_features(song_file_name, duration_seconds, sampling_rate=22050, hop_length=512):
+    y, sr = librosa.load(f'{SONG_DIRECTORY}/{song_file_name}', sr=sampling_rate, duration=duration_seconds, offset=0)
     bpm = get_bpm(song_file_name)
     if bpm is None:
-        bpm = compute_bpm(y=y, sr=sr)[0]
+        bpm = compute_bpm(y=y, sr=sr, hop_length=hop_length)[0]
     # zero_crossing_rate = compute_zero_crossing_rate(y=y)
     # spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
     # mfcc = librosa.feature.mfcc(y=y, sr=sr)
     # spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr)
-    chroma_stft = librosa.feature.chroma_stft(y=y, sr=sr)
+    chroma_stft = librosa.feature.chroma_stft(y=y, sr=sr, hop_length=hop_length)
     return {'bpm': bpm, 'chroma_stft': chroma_stft}
 
 
-def compute_bpm(y, sr):
-    return librosa.feature.tempo(y=y, sr=sr)
+def compute_extended_features(song_file_name, duration_seconds):
+    y, sr = librosa.load(f'{SONG_DIRECTORY}/{song_file_name}', duration=duration_seconds, offset=0)
+    tempo = compute_bpm(y=y, sr=sr)[0]
+    bpm = get_bpm(song_file_name)
+    return {'bpm': tempo if bpm is None else bpm,
+            'tempo': tempo,
+            'chroma_stft': librosa.feature.chroma_stft(y=y, sr=sr),
+            'zero_crossing_rate': librosa.feature.zero_crossing_rate(y=y)[0],
+            'spectral_centroid': librosa.feature.spectral_centroid(y=y, sr=sr)[0],
+            'spectral_bandwidth': librosa.feature.spectral_bandwidth(y=y, sr=sr)[0],
+            'mfcc': librosa.feature.mfcc(y=y, sr=sr)}
+
+
+def compute_bpm(y, sr, hop_length=512):
+    return librosa.feature.tempo(y=y, sr=sr, hop_length=hop_length)
 
 
 def set_bpm(song, bpm):
@@ -39,17 +53,30 @@ def set_bpm(song, bpm):
 
 
 def get_bpm(song):
-    mp3file = MP3(f'{SONG_DIRECTORY}/{song}', ID3=EasyID3)
+    return get_metadata(song)[0]
+
+
+def get_metadata(song):
+    # BPM from the ID3 tag (None if it isn't set) and duration in seconds
+    try:
+        mp3file = MP3(f'{SONG_DIRECTORY}/{song}', ID3=EasyID3)
+    except MutagenError:
+        # Not an MP3 (e.g. a WAV file), so there is no BPM tag
+        return None, librosa.get_duration(path=f'{SONG_DIRECTORY}/{song}')
     bpm_list = mp3file.get('bpm', None)
-    return int(bpm_list[0]) if bpm_list is not None else None
+    return (int(bpm_list[0]) if bpm_list is not None else None), mp3file.info.length
 
 
-def compute_all_bpm():
+def list_songs():
     song_list = []
     song_categories = os.listdir(SONG_DIRECTORY)
     for category in song_categories:
         song_list += [f'{category}/{song}' for song in os.listdir(f'{SONG_DIRECTORY}/{category}')]
-    for song_file_name in song_list:
+    return song_list
+
+
+def compute_all_bpm():
+    for song_file_name in list_songs():
         if get_bpm(song_file_name) is None:
             song_bpm = compute_bpm_from_file(song_file_name)
             set_bpm(song_file_name, song_bpm)
@@ -0,0 +1,118 @@
+import collections
+import os
+import threading
+import time
+
+import numpy as np
+
+from song_bpm_utils import get_metadata, list_songs, SONG_DIRECTORY
+
+REFRESH_SECONDS = 60  # Time between background rescans of the song directory
+
+
+# Immutable snapshot of the catalog, replaced as a whole by a refresh
+CatalogState = collections.namedtuple('CatalogState', ['songs', 'index', 'categories', 'category_codes', 'bpms',
+                                                       'durations', 'mtimes'])
+
+
+class SongCatalog:
+    """Index of the song library: path, category, BPM, duration and mtime of every song in compact arrays.
+
+    A refresh stats every file but only reads the metadata of new or changed songs. Unknown BPMs are stored as -1.
+    Refreshes build a new snapshot and swap it in, so lookups never wait for a rescan; start_refreshing rescans in a
+    background thread."""
+
+    def __init__(self):
+        self.refresh_lock = threading.Lock()
+        self.state = CatalogState([], dict(), [], np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int16),
+                                  np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64))
+        self.refresher = None
+        self.refresh()
+
+    def refresh(self):
+        with self.refresh_lock:
+            songs = sorted(list_songs())
+            categories = sorted({song.split('/')[0] for song in songs})
+            category_codes = np.array([categories.index(song.split('/')[0]) for song in songs], dtype=np.int16)
+            bpms = np.full(len(songs), -1, dtype=np.int16)
+            durations = np.zeros(len(songs), dtype=np.float32)
+            mtimes = np.zeros(len(songs), dtype=np.int64)
+
+            old = self.state
+            for i, song in enumerate(songs):
+                mtimes[i] = os.stat(f'{SONG_DIRECTORY}/{song}').st_mtime_ns
+                position = old.index.get(song)
+                if position is not None and old.mtimes[position] == mtimes[i]:
+                    bpms[i], durations[i] = old.bpms[position], old.durations[position]
+                    continue
+                try:
+                    bpm, durations[i] = get_metadata(song)
+                except Exception as error:
+                    print(f'Could not read metadata of {song}: {error}')
+                    continue
+                if bpm is not None:
+                    bpms[i] = bpm
+
+            self.state = CatalogState(songs, {song: i for i, song in enumerate(songs)}, categories, category_codes,
+                                      bpms, durations, mtimes)
+
+    def start_refreshing(self, interval=REFRESH_SECONDS):
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self.refresh_forever, args=(interval,), daemon=True)
+            self.refresher.start()
+
+    def refresh_forever(self, interval=REFRESH_SECONDS):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except OSError as error:
+                print(f'Could not rescan the songs: {error}')
+
+    def song_list(self):
+        return list(self.state.songs)
+
+    def bpm(self, song):
+        state = self.state
+        bpm = int(state.bpms[state.index[song]])
+        return bpm if bpm >= 0 else None
+
+    def duration(self, song):
+        state = self.state
+        return float(state.durations[state.index[song]])
+
+    def mtime(self, song):
+        state = self.state
+        return int(state.mtimes[state.index[song]])
+
+    def category(self, song):
+        state = self.state
+        return state.categories[state.category_codes[state.index[song]]]
+
+    def bpm_by_song(self):
+        # Only the songs with a known BPM
+        state = self.state
+        return {song: int(bpm) for song, bpm in zip(state.songs, state.bpms) if bpm >= 0}
+
+    def __len__(self):
+        return len(self.state.songs)
+
+    def __contains__(self, song):
+        return song in self.state.index
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Returns the process-wide song catalog, building it on first use; it is rescanned in the background."""
+    global _catalog
+    catalog = _catalog
+    if catalog is not None:
+        return catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = SongCatalog()
+            _catalog.start_refreshing()
+        return _catalog
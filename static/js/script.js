@@ -65,8 +65,9 @@ function startImageSendingInterval(userId, timeout = 1000) {
     // Continuously send image to server
     return setInterval(function() {
         context.drawImage(video, 0, 0, 640, 480);
-        const data = canvas.toDataURL("image/jpeg");
-        sendImage(data, userId);
+        // Capture time in seconds, the server uses it to place the frame on its time axis
+        const captured = (performance.timeOrigin + performance.now()) / 1000;
+        canvas.toBlob(data => sendImage(data, userId, captured), "image/jpeg");
     }, timeout);
 }
 
@@ -74,15 +75,15 @@ function stopInterval(interval) {
     clearInterval(interval);
 }
 
-function sendImage(data, userId) {
+function sendImage(data, userId, captured) {
     // Send a POST request to the server
-    fetch('/image', {
+    fetch('/image?' + new URLSearchParams({
+        user_id: userId,
+        t: captured
+    }), {
         method: 'POST',
-        headers: new Headers({'content-type': 'application/json'}),
-        body: JSON.stringify({
-            image: data,
-            user_id: userId
-        })
+        headers: new Headers({'content-type': 'image/jpeg'}),
+        body: data
     })
         .then(response => response.text())
         .catch(error => {
@@ -110,7 +111,7 @@ function startExperiment() {
     document.getElementById("message").innerText = "The experiment has begun. Please wait a few seconds for the music to start."
     // Get a user id from server
     getUserId()
-        .then(getAction)
+        .then(listenForActions)
         .catch(error => {
             console.error(error);
         });
@@ -125,31 +126,31 @@ function endExperiment() {
     document.getElementById("message").innerText = ""
 }
 
-function getAction(userId) {
-    // get new action
-    fetch('/action?' + new URLSearchParams({
+function listenForActions(userId) {
+    // Receive actions from the server as they happen
+    const source = new EventSource('/action/stream?' + new URLSearchParams({
         user_id: userId
-    }), {
-        headers: {'X-Requested-With': 'XMLHttpRequest'}
-    })
-        .then(response => response.text())
-        .then(data => {
-            // Perform the action
-            if (data === 'start') {
-                startProcedure(userId);
-                getAction(userId);
-            } else if (data === 'end') {
-                endExperiment()
-            } else {
-                // console.log("received song:", data);
-                document.getElementById("message").innerText = ""
-                playNewSong(userId, data);
-                sendImages(userId, 1000/IMAGE_FPS, SONG_DURATION);
-            }
-        })
-        .catch(error => {
-            console.error(error);
-        });
+    }));
+    source.onmessage = event => {
+        const data = event.data;
+        // Perform the action
+        if (data === 'start') {
+            startProcedure(userId);
+        } else if (data === 'end') {
+            source.close();
+            endExperiment()
+        } else {
+            // console.log("received song:", data);
+            document.getElementById("message").innerText = ""
+            playNewSong(data);
+            sendImages(userId, 1000/IMAGE_FPS, SONG_DURATION);
+        }
+    };
+    source.onerror = error => {
+        // The browser reconnects on its own
+        console.error(error);
+    };
+    return source;
 }
 
 function requestStop(userId) {
@@ -168,13 +169,14 @@ function requestStop(userId) {
         });
 }
 
-function playNewSong(userId, songFileName) {
+function playNewSong(songFileName) {
+    // The next song can arrive before the previous one ended, its timer must not pause the new song
+    clearTimeout(pauseTimeout);
     document.getElementById("audioSource").src = songFileName;
     document.getElementById("music").load();
     play_music("music", 0);
-    setTimeout(() => {
+    pauseTimeout = setTimeout(() => {
         document.getElementById("music").pause();
-        getAction(userId);
     }, SONG_DURATION * 1000);
 }
 
@@ -195,6 +197,7 @@ async function getUserId() {
 }
 
 let currentPageIndex = 0;
+let pauseTimeout = null;  // Pauses the current song after SONG_DURATION
 const pageOrder = ['/welcome', '/experiment', '/thanks'];
 
 const video = document.getElementById('video');
@@ -0,0 +1,42 @@
+import argparse
+import multiprocessing
+import os
+
+from metrics import get_metrics
+from model_registry import ModelRegistry
+from session_backend import make_backend
+from session_manager import MAX_SESSIONS, SessionManager
+
+METRICS_LOG_FILE = 'static/logs/metrics-worker{}.jsonl'
+
+
+def run_worker(backend_url, max_sessions=MAX_SESSIONS, worker=0):
+    """Trains the sessions that the web servers submit to the backend, at most max_sessions at the same time."""
+    # The launcher made every model available again, the other workers may have checked some out since
+    model_registry = ModelRegistry(release_all=False)
+    get_metrics().start_logging(METRICS_LOG_FILE.format(worker))
+    sessions = SessionManager(model_registry=model_registry, max_sessions=max_sessions,
+                              backend=make_backend(backend_url))
+    sessions.claim_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the sessions of web servers running with SESSION_BACKEND.')
+    parser.add_argument('--backend', default=os.environ.get('SESSION_BACKEND'),
+                        help='URL of the shared session backend, e.g. redis://localhost:6379/0 '
+                             '(default: the SESSION_BACKEND environment variable)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, each with its own learner')
+    parser.add_argument('--sessions', type=int, default=MAX_SESSIONS, help='sessions trained per worker')
+    args = parser.parse_args()
+    if args.backend is None or args.backend == 'memory':
+        parser.error('workers need a backend shared with the web servers, e.g. --backend redis://localhost:6379/0')
+
+    # Every saved model can be handed out again after a restart
+    ModelRegistry()
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(args.backend, args.sessions, worker))
+               for worker in range(args.workers)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
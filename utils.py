@@ -1,32 +1,92 @@
+import glob
 import os
+import queue
 import urllib.request
+from concurrent.futures import ProcessPoolExecutor
 from functools import wraps
 
 import cv2
 import numpy as np
 from flask import request, redirect, make_response
 
+from experience_log import ExperienceLogs, LOG_COLUMNS, parse_experience_log
 
-def decode_image(image_data):
+
+READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+              8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def decode_image(image_data, reduction=1):
     # Parse the URL data into actual binary data
     with urllib.request.urlopen(image_data) as res:
         jpg_data = res.read()
+    return decode_image_bytes(jpg_data, reduction=reduction)
+
 
-    # Convert the raw data into an OpenCV image
+def decode_image_bytes(jpg_data, reduction=1):
+    # Convert the raw data into an OpenCV image (without copying the buffer)
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, which is much cheaper than decoding and resizing
+    # Returns None for data that isn't an image, like cv2.imdecode does (which raises for empty data instead)
+    if len(jpg_data) == 0:
+        return None
     np_data = np.frombuffer(jpg_data, dtype=np.uint8)
-    image = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
+    image = cv2.imdecode(np_data, READ_FLAGS[reduction])
     return image
 
 
-def create_initial_agent_queue(queue):
-    tmp_dirs = os.listdir('static/logs')
-    tmp_dirs.sort()  # Put the most recent models last in the queue (so they are first used)
-    for directory in tmp_dirs:
-        files = os.listdir(f'static/logs/{directory}')
-        files.sort()
-        for file in files:
-            if ".zip" in file and "backup" not in file:
-                queue.put(f'static/logs/{directory}/{file}')
+def put_back(fifo_queue, item):
+    """Puts an item back at the front of a queue, so it is the next one to be taken."""
+    if hasattr(fifo_queue, 'put_front'):
+        fifo_queue.put_front(item)
+        return
+    with fifo_queue.mutex:
+        fifo_queue.queue.appendleft(item)
+        fifo_queue.unfinished_tasks += 1
+        fifo_queue.not_empty.notify()
+
+
+def put_latest(bounded_queue, item):
+    """Puts an item on a bounded queue, dropping the oldest items if the queue is full."""
+    while True:
+        try:
+            bounded_queue.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                bounded_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def read_experience_logs(log_directory='static/logs', workers=None, cache_directory=None):
+    """Reads the experience logs of all sessions into one ExperienceLogs object.
+
+    The files are parsed in parallel. With a cache directory, the columns are stored there and memory-mapped, and
+    later calls reuse them as long as no log file was added or changed."""
+    filenames = sorted(glob.glob(os.path.join(log_directory, '**', 'experience_log.csv'), recursive=True))
+    mtimes = [os.stat(filename).st_mtime_ns for filename in filenames]
+
+    if cache_directory is not None:
+        try:
+            logs = ExperienceLogs.load(cache_directory)
+            if logs.sessions == filenames and logs.mtimes == mtimes:
+                return logs
+        except (OSError, KeyError, ValueError):
+            pass  # No usable cache yet
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(parse_experience_log, filenames, chunksize=16))
+    columns = dict()
+    for name, dtype in LOG_COLUMNS.items():
+        columns[name] = np.concatenate([session[name] for _, session in parsed]) if parsed else np.zeros(0, dtype)
+    columns['session'] = np.repeat(np.arange(len(parsed), dtype=np.int32),
+                                   [len(session['heart_bpm']) for _, session in parsed])
+    logs = ExperienceLogs(filenames, [metadata for metadata, _ in parsed], columns, mtimes=mtimes)
+
+    if cache_directory is not None:
+        logs.save(cache_directory)
+        logs = ExperienceLogs.load(cache_directory)
+    return logs
 
 
 def inner_content(f):